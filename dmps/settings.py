@@ -120,29 +120,36 @@ LOGGING = {
             "format": "%(log_color)s %(levelname)-8s %(asctime)s "
             "%(module)s %(reset)s %(white)s%(message)s",
         },
+        "json": {
+            "()": "stats.log.JsonFormatter",
+        },
     },
     "handlers": {
         "log_to_stdout": {
             "level": "DEBUG",
             "class": "logging.StreamHandler",
             "stream": sys.stdout,
-            "formatter": "colored",
+            "formatter": env.str("LOG_FORMATTER", "colored"),
         },
     },
     "loggers": {
         "main": {
             "handlers": ["log_to_stdout"],
-            "level": "DEBUG",
+            "level": env.str("LOG_LEVEL", "INFO"),
             "propagate": True,
         },
         "mappings": {
             "handlers": ["log_to_stdout"],
-            "level": "DEBUG",
+            "level": env.str("LOG_LEVEL_MAPPINGS", env.str("LOG_LEVEL", "INFO")),
             "propagate": True,
         },
     },
 }
 
+# the handlers of these loggers write from a listener thread (stats.log)
+LOG_QUEUE = env.bool("LOG_QUEUE", True)
+QUEUED_LOGGERS = ["main", "mappings"]
+
 
 WSGI_APPLICATION = "dmps.wsgi.application"
 
@@ -150,12 +157,93 @@ WSGI_APPLICATION = "dmps.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
-DATABASES = {
+# DJANGO_DB_ENGINE=postgresql selects PostgreSQL (POSTGRES_* variables),
+# SQLite is the default
+if env.str("DJANGO_DB_ENGINE", "sqlite3") == "postgresql":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": env.str("POSTGRES_DB", "postgres"),
+            "USER": env.str("POSTGRES_USER", "postgres"),
+            "PASSWORD": env.str("POSTGRES_PASSWORD", ""),
+            "HOST": env.str("POSTGRES_HOST", "localhost"),
+            "PORT": env.int("POSTGRES_PORT", 5432),
+            # persistent connections, reused by the requests of a worker
+            "CONN_MAX_AGE": env.int("DJANGO_CONN_MAX_AGE", 600),
+            # QuerySet.iterator() (e.g. the exports) streams through server-side
+            # cursors, disable them behind a transaction pooler like PgBouncer
+            "DISABLE_SERVER_SIDE_CURSORS": env.bool(
+                "POSTGRES_DISABLE_SERVER_SIDE_CURSORS", False
+            ),
+        }
+    }
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": BASE_DIR / "db.sqlite3",
+        }
+    }
+# the stats views read through a connection of their own, so dashboards are not
+# blocked while fetch writes on the primary, see stats/routers.py
+# (on PostgreSQL a streaming replica, if POSTGRES_READ_HOST is set)
+DATABASES["read"] = {**DATABASES["default"], "TEST": {"MIRROR": "default"}}
+if DATABASES["default"]["ENGINE"] == "django.db.backends.postgresql":
+    DATABASES["read"]["HOST"] = env.str(
+        "POSTGRES_READ_HOST", DATABASES["default"]["HOST"]
+    )
+DATABASE_ROUTERS = ["stats.routers.ReadRouter"]
+STATS_READ_DATABASE = env.str("STATS_READ_DATABASE", "read")
+
+# applied to every SQLite connection, in WAL mode readers never wait for writers
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",  # no fsync per commit, still safe in WAL mode
+    "busy_timeout": env.int("SQLITE_BUSY_TIMEOUT", 5000),  # ms
+    "cache_size": -64000,  # 64 MB
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "memory",
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# stats responses are cached until the next fetch run bumps the data version
+
+CACHES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "BACKEND": env.str(
+            "DJANGO_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": env.str("DJANGO_CACHE_LOCATION", "dmps-stats"),
     }
 }
+STATS_CACHE_TIMEOUT = env.int("STATS_CACHE_TIMEOUT", 60 * 60 * 24)
+
+# columnar snapshot of the statistics, written by fetch and memory-mapped by the views
+STATS_SNAPSHOT_DIR = env.str("STATS_SNAPSHOT_DIR", str(BASE_DIR / "snapshot"))
+
+# Prometheus text file written by fetch and served by the metrics view
+STATS_METRICS_FILE = env.str("STATS_METRICS_FILE", str(BASE_DIR / "metrics.prom"))
+# progress of the running (or last) fetch, served by the progress view
+STATS_PROGRESS_FILE = env.str(
+    "STATS_PROGRESS_FILE", str(BASE_DIR / "fetch-progress.json")
+)
+
+# sync_daemon: seconds between polls of DMPonline, and the number of polls
+# between checks for plans deleted from DMPonline
+SYNC_INTERVAL = env.int("SYNC_INTERVAL", 300)
+SYNC_SWEEP_EVERY = env.int("SYNC_SWEEP_EVERY", 12)
+
+# processes mapping the plans of fetch (fetch --workers), 0 maps them in the
+# fetch process itself
+MAPPING_WORKERS = env.int("MAPPING_WORKERS", 0)
+
+# fetch --shard: seconds a shard keeps a plan from the other shards
+PLAN_LEASE_SECONDS = env.int("PLAN_LEASE_SECONDS", 3600)
+# fetch and sync_daemon hold a run lease, renewed every third of this, a
+# lease not renewed for this many seconds is stale
+RUN_LEASE_SECONDS = env.int("RUN_LEASE_SECONDS", 300)
 
 
 # Password validation
@@ -7,6 +7,10 @@ from stats.models import (
     ShareType,
     StorageLocation,
     DataUser,
+    Researcher,
+    SyncRun,
+    PlanLease,
+    RunLease,
 )
 
 
@@ -18,6 +22,20 @@ class DMPAdmin(admin.ModelAdmin):
     inlines = [DataUserInline]
 
 
+class SyncRunAdmin(admin.ModelAdmin):
+    list_display = [
+        "started",
+        "finished",
+        "status",
+        "begin_page",
+        "end_page",
+        "shard",
+        "plans_per_second",
+    ]
+    list_filter = ["status"]
+    readonly_fields = ["counters", "stage_seconds"]
+
+
 admin.site.register(DMP, DMPAdmin)
 admin.site.register(DataType)
 admin.site.register(FacultyDepartment)
@@ -25,3 +43,7 @@ admin.site.register(Position)
 admin.site.register(ShareType)
 admin.site.register(StorageLocation)
 admin.site.register(DataUser)
+admin.site.register(Researcher)
+admin.site.register(SyncRun, SyncRunAdmin)
+admin.site.register(PlanLease)
+admin.site.register(RunLease)
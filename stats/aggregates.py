@@ -0,0 +1,330 @@
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.db import connection, connections, transaction
+from django.db.models import (
+    BooleanField,
+    Count,
+    DateField,
+    F,
+    IntegerField,
+    Sum,
+    TextField,
+    Value,
+)
+from django.db.models.functions import Cast, TruncMonth
+
+from stats.models import DMP, Aggregate, Researcher, Rollup
+
+logger = logging.getLogger("main")
+
+AGGREGATES = [
+    ("template_name", "Template kind"),
+    ("researchers__faculty_department__name", "Faculty-Department"),
+    ("human_participants", "Work with human participants"),
+    ("personal_data", "Work with personal data"),
+    ("confidential_data", "Work with confidential data"),
+    ("storage_locations__name", "Used storage location"),
+    ("data_amount", "Data amount"),
+    ("data_types_public__name", "What types of data will be shared"),
+    ("share_types__name", "How will research data be shared"),
+    ("data_amount_public", "How much data will be made public"),
+]
+
+STORAGE_FIELDS = ("data_amount", "data_amount_public")
+PERCENTILES = (50, 90, 99)
+
+
+# counts the DMPs giving every answer of one question, a DMP with several users
+# in one faculty-department is counted once
+# returns [(value, total), ...] with the values in sorted order
+def compute_aggregate(question):
+    return list(
+        DMP.objects.order_by(F(question).asc(nulls_first=True))
+        .values(question)
+        .annotate(total=Count("pk", distinct=True))
+        .values_list(question, "total")
+    )
+
+
+# None sorts first, like NULL in the database
+def sort_key(value):
+    return value is not None, value
+
+
+# the model field at the end of a lookup like "storage_locations__name"
+def get_lookup_field(lookup):
+    model = DMP
+    for name in lookup.split("__"):
+        field = model._meta.get_field(name)
+        model = field.related_model
+    return field
+
+
+# a value cast to text by facet_queryset() back to the field's Python type
+def from_text(field, value):
+    if value is None:
+        return None
+    if isinstance(field, BooleanField):
+        return value.lower() in ("1", "t", "true")  # SQLite 1, PostgreSQL true
+    return field.to_python(value)
+
+
+# the grouped query of every AGGREGATES question as (position, value, total)
+# rows, values cast to text so the subqueries can be combined in one UNION ALL
+def facet_queryset():
+    querysets = [
+        get_facet_queryset(DMP.objects.all(), position)
+        for position in range(len(AGGREGATES))
+    ]
+    return querysets[0].union(*querysets[1:], all=True)
+
+
+# the DMPs of the queryset counted per answer of one question (and per group
+# annotation, e.g. month) as (position, *group, value as text, total) rows
+def get_facet_queryset(queryset, position, group=()):
+    return (
+        queryset.order_by()
+        .annotate(
+            facet=Value(position, output_field=IntegerField()),
+            facet_value=Cast(AGGREGATES[position][0], TextField()),
+        )
+        .values("facet", *group, "facet_value")
+        .annotate(total=Count("pk", distinct=True))
+        .values_list("facet", *group, "facet_value", "total")
+    )
+
+
+# PostgreSQL counts the single-valued questions (columns of the DMP table) in a
+# single scan, one grouping set per question (plus the group annotations, e.g.
+# month) and GROUPING() telling which question a row counts; every multi-valued
+# question is a grouped subquery of its own, so its join never multiplies the
+# rows of another question, and all of it is one UNION ALL
+# yields (position, *group values, value as text, total) rows
+def count_grouping_sets(queryset, group=()):
+    queryset = queryset.order_by()
+    quote_name = connections[queryset.db].ops.quote_name
+    single = [
+        position
+        for position, question in enumerate(AGGREGATES)
+        if "__" not in question[0]
+    ]
+    lookups = [AGGREGATES[position][0] for position in single]
+    # Django selects annotations (the group columns) after the fields
+    facts = queryset.values_list("pk", *lookups, *group)
+    sql, params = facts.query.get_compiler(queryset.db).as_sql()
+    group_columns = [f"g{i}" for i in range(len(group))]
+    columns = [f"c{i}" for i in range(len(lookups))]
+    grouping = f"GROUPING({', '.join(columns)})"
+    # the bit of a column is 0 in the grouping sets that group by it
+    masks = [
+        (2 ** len(columns) - 1) ^ (1 << (len(columns) - 1 - i))
+        for i in range(len(columns))
+    ]
+    position_case = " ".join(
+        f"WHEN {mask} THEN {position}" for mask, position in zip(masks, single)
+    )
+    value_case = " ".join(
+        f"WHEN {mask} THEN CAST({column} AS text)"
+        for mask, column in zip(masks, columns)
+    )
+    grouping_sets = ", ".join(
+        "(" + ", ".join([*group_columns, column]) + ")" for column in columns
+    )
+    parts = [
+        f"SELECT CASE {grouping} {position_case} END, "
+        f"{''.join(f'{column}, ' for column in group_columns)}"
+        f"CASE {grouping} {value_case} END, COUNT(DISTINCT id) "
+        f"FROM ({sql}) AS facts(id, {', '.join([*columns, *group_columns])}) "
+        f"GROUP BY GROUPING SETS ({grouping_sets})"
+    ]
+    for position in range(len(AGGREGATES)):
+        if position not in single:
+            facet_sql, facet_params = (
+                get_facet_queryset(queryset, position, group)
+                .query.get_compiler(queryset.db)
+                .as_sql()
+            )
+            parts.append(
+                f'SELECT "facet", {"".join(f"{quote_name(name)}, " for name in group)}'
+                f'"facet_value", "total" FROM ({facet_sql}) AS facet{position}'
+            )
+            params += facet_params
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(" UNION ALL ".join(parts), params)
+        yield from cursor.fetchall()
+
+
+# the counts of all AGGREGATES questions in one database round trip, grouped
+# per question so multi-valued questions never multiply each other's rows
+# returns {question: [(value, total), ...]} with the values in sorted order
+def compute_aggregates():
+    aggregates = {question[0]: [] for question in AGGREGATES}
+    fields = [get_lookup_field(question[0]) for question in AGGREGATES]
+    if connections[DMP.objects.db].vendor == "postgresql":
+        rows = count_grouping_sets(DMP.objects.all())
+    else:
+        rows = facet_queryset()
+    for position, value, total in rows:
+        aggregates[AGGREGATES[position][0]].append(
+            (from_text(fields[position], value), total)
+        )
+    return {
+        question: sorted(rows, key=lambda row: sort_key(row[0]))
+        for question, rows in aggregates.items()
+    }
+
+
+# the same query on a thread of its own, which has its own database connection
+# and gets no request_finished signal to close it
+def compute_aggregate_in_thread(question):
+    try:
+        return compute_aggregate(question)
+    finally:
+        connections.close_all()
+
+
+# runs the AGGREGATES queries concurrently, so the latency is roughly that of
+# the slowest query instead of the sum of all of them; inside a transaction
+# (e.g. in tests) other connections would not see its rows, so they run as the
+# single query of compute_aggregates() on this connection
+async def compute_aggregates_async():
+    if await sync_to_async(lambda: connection.in_atomic_block)():
+        return await sync_to_async(compute_aggregates)()
+    totals = await asyncio.gather(
+        *[
+            sync_to_async(compute_aggregate_in_thread, thread_sensitive=False)(
+                question[0]
+            )
+            for question in AGGREGATES
+        ]
+    )
+    return {question[0]: total for question, total in zip(AGGREGATES, totals)}
+
+
+# replaces the materialised Aggregate table, called at the end of every fetch run
+def rebuild_aggregates():
+    aggregates = compute_aggregates()
+    with transaction.atomic():
+        Aggregate.objects.all().delete()
+        Aggregate.objects.bulk_create(
+            Aggregate(question=question, value=value, total=total)
+            for question, rows in aggregates.items()
+            for value, total in rows
+        )
+    logger.info(f"Rebuilt {Aggregate.objects.count()} aggregate rows")
+
+
+# reads all aggregates in one query, returns None if the table
+# has not been built yet (e.g. before the first fetch)
+def read_aggregates():
+    aggregates = {question[0]: [] for question in AGGREGATES}
+    rows = Aggregate.objects.order_by("id").values_list("question", "value", "total")
+    for question, value, total in rows:
+        if question in aggregates:
+            aggregates[question].append((value, total))
+    return aggregates if rows else None
+
+
+# the materialised aggregates, or counted if the table has not been built yet
+def get_aggregates():
+    return read_aggregates() or compute_aggregates()
+
+
+async def get_aggregates_async():
+    return await sync_to_async(read_aggregates)() or await compute_aggregates_async()
+
+
+# replaces the monthly rollups (DMPs created per month per answer),
+# called at the end of every fetch run
+def rebuild_rollups():
+    queryset = DMP.objects.filter(created__isnull=False).annotate(
+        month=TruncMonth("created", output_field=DateField())
+    )
+    if connections[queryset.db].vendor == "postgresql":
+        fields = [get_lookup_field(question[0]) for question in AGGREGATES]
+        rows = [
+            (position, month, from_text(fields[position], value), total)
+            for position, month, value, total in count_grouping_sets(
+                queryset, group=("month",)
+            )
+        ]
+        rows.sort(key=lambda row: (row[0], row[1], sort_key(row[2])))
+        rollups = [
+            Rollup(
+                month=month, question=AGGREGATES[position][0], value=value, total=total
+            )
+            for position, month, value, total in rows
+        ]
+    else:
+        rollups = [
+            Rollup(month=month, question=question[0], value=value, total=total)
+            for question in AGGREGATES
+            for month, value, total in queryset.order_by(
+                "month", F(question[0]).asc(nulls_first=True)
+            )
+            .values("month", question[0])
+            .annotate(total=Count("pk", distinct=True))
+            .values_list("month", question[0], "total")
+        ]
+    with transaction.atomic():
+        Rollup.objects.all().delete()
+        Rollup.objects.bulk_create(rollups)
+    logger.info(f"Rebuilt {len(rollups)} monthly rollup rows")
+
+
+# [(month, [(value, total), ...]), ...] for one question, oldest month first
+def get_rollups(question):
+    months = {}
+    rows = (
+        Rollup.objects.filter(question=question)
+        .order_by("month", "id")
+        .values_list("month", "value", "total")
+    )
+    for month, value, total in rows:
+        months.setdefault(month, []).append((value, total))
+    return list(months.items())
+
+
+# histogram, total and percentiles of a storage amount from one grouped query
+# on its indexed bucket column, percentiles are the lower bound of their bucket
+# open-ended answers ("> 5 TB") get bins of their own, after the bounded ones
+def get_storage_distribution(field):
+    buckets = list(
+        DMP.objects.filter(**{field + "_bucket__isnull": False})
+        .order_by(field + "_bucket", field + "_open_ended")
+        .values(field + "_bucket", field + "_open_ended")
+        .annotate(count=Count("pk"), total=Sum(field + "_bytes"))
+        .values_list(field + "_bucket", field + "_open_ended", "count", "total")
+    )
+    count = sum(n for bucket, open_ended, n, total in buckets)
+    percentiles = {}
+    for percentile in PERCENTILES:
+        cumulative = 0
+        for bucket, open_ended, n, total in buckets:
+            cumulative += n
+            if cumulative * 100 >= count * percentile:
+                percentiles[str(percentile)] = 2**bucket
+                break
+    return {
+        "count": count,
+        "total_bytes": sum(total for bucket, open_ended, n, total in buckets),
+        "histogram": [
+            [2**bucket, n, total, open_ended]
+            for bucket, open_ended, n, total in buckets
+        ],
+        "percentiles": percentiles,
+    }
+
+
+# [(faculty-department, researchers), ...], one indexed count over the researchers
+# that still have a DMP (their plans may have been deleted or handed over)
+def get_researcher_counts():
+    return list(
+        Researcher.objects.filter(dmps__isnull=False)
+        .order_by(F("faculty_department__name").asc(nulls_first=True))
+        .values("faculty_department__name")
+        .annotate(total=Count("pk", distinct=True))
+        .values_list("faculty_department__name", "total")
+    )
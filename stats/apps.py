@@ -1,6 +1,22 @@
+import atexit
+
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
 
 
 class StatsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "stats"
+
+    def ready(self):
+        from stats.routers import configure_sqlite
+
+        connection_created.connect(configure_sqlite)
+
+        if settings.LOG_QUEUE:
+            from stats.log import queue_loggers
+
+            listener = queue_loggers(settings.QUEUED_LOGGERS)
+            if listener:
+                atexit.register(listener.stop)
@@ -0,0 +1,160 @@
+import asyncio
+import uuid
+from calendar import timegm
+from datetime import datetime
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from stats.helpers import get_md5
+from stats.models import DataVersion
+from stats.snapshot import load_snapshot, read_snapshot_version
+
+
+# the version of the current snapshot, which needs no database access,
+# or the one stored by the last fetch run
+def get_data_version():
+    version = read_snapshot_version()
+    if version:
+        return version
+    data_version = DataVersion.objects.filter(pk=1).first()
+    return data_version.version if data_version else "0"
+
+
+# version and modification time, looked up once per request and shared by
+# the ETag, the Last-Modified header and the cache key
+def get_request_data_state(request):
+    if not hasattr(request, "stats_data_state"):
+        snapshot = load_snapshot()
+        if snapshot:
+            state = (snapshot.version, datetime.fromisoformat(snapshot.created))
+        else:
+            data_version = DataVersion.objects.filter(pk=1).first()
+            state = (
+                (data_version.version, data_version.updated)
+                if data_version
+                else ("0", None)
+            )
+        request.stats_data_state = state
+    return request.stats_data_state
+
+
+# called at the end of every fetch run, all cached stats responses go stale at once
+def bump_data_version():
+    version = uuid.uuid4().hex
+    DataVersion.objects.update_or_create(pk=1, defaults={"version": version})
+    return version
+
+
+# sorted keys and values, so ?a=1&b=2 and ?b=2&a=1 share one cache entry
+def normalise_query(query_dict):
+    return "&".join(
+        f"{key}={value}"
+        for key in sorted(query_dict)
+        for value in sorted(query_dict.getlist(key))
+    )
+
+
+def stats_cache_key(view_name, request):
+    query = get_md5(normalise_query(request.GET))
+    version, _ = get_request_data_state(request)
+    return f"stats:{view_name}:{version}:{query}"
+
+
+# renders a TemplateResponse, so the cached copy holds its content,
+# and caches it until the next fetch run
+def store_response(key, response):
+    if hasattr(response, "render"):  # TemplateResponse
+        response.render()
+    if response.status_code == 200:
+        cache.set(key, response, settings.STATS_CACHE_TIMEOUT)
+    return response
+
+
+# caches the (rendered) response of a stats view until the next fetch run
+def cache_stats(view):
+    if asyncio.iscoroutinefunction(view):
+
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return await view(request, *args, **kwargs)
+            key = await sync_to_async(stats_cache_key)(view.__name__, request)
+            response = await sync_to_async(cache.get)(key)
+            if response is None:
+                response = await view(request, *args, **kwargs)
+                response = await sync_to_async(store_response)(key, response)
+            return response
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return view(request, *args, **kwargs)
+        key = stats_cache_key(view.__name__, request)
+        response = cache.get(key)
+        if response is None:
+            response = store_response(key, view(request, *args, **kwargs))
+        return response
+
+    return wrapper
+
+
+# ETag from the data version and Last-Modified timestamp from its modification time
+def get_validators(request):
+    version, modified = get_request_data_state(request)
+    return quote_etag(version), modified and timegm(modified.utctimetuple())
+
+
+# like django.views.decorators.http.condition, which cannot wrap async views
+def set_validators(request, response, etag, last_modified):
+    if request.method in ("GET", "HEAD"):
+        if last_modified and not response.has_header("Last-Modified"):
+            response.headers["Last-Modified"] = http_date(last_modified)
+        response.headers.setdefault("ETag", etag)
+    return response
+
+
+# the logic of gzip_page (which cannot wrap async views), only the stats
+# responses are compressed: they hold no secrets like the CSRF token of the
+# admin pages, which compression would expose to BREACH
+gzip = GZipMiddleware(lambda request: None)
+
+
+# ETag and Last-Modified from the data version, conditional requests of
+# polling clients are answered with 304 Not Modified, the responses are
+# compressed (weakening their ETag) for clients accepting gzip
+def conditional_stats(view):
+    if asyncio.iscoroutinefunction(view):
+
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            etag, last_modified = await sync_to_async(get_validators)(request)
+            response = get_conditional_response(
+                request, etag=etag, last_modified=last_modified
+            )
+            if response is None:
+                response = await view(request, *args, **kwargs)
+            response = set_validators(request, response, etag, last_modified)
+            return gzip.process_response(request, response)
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        etag, last_modified = get_validators(request)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = view(request, *args, **kwargs)
+        response = set_validators(request, response, etag, last_modified)
+        return gzip.process_response(request, response)
+
+    return wrapper
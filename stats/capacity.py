@@ -0,0 +1,45 @@
+import numpy as np
+
+from stats.aggregates import PERCENTILES
+
+# question: name of the grouped sums in the result
+CAPACITY_GROUPS = (
+    ("researchers__faculty_department__name", "by_faculty_department"),
+    ("storage_locations__name", "by_storage_location"),
+)
+
+
+# totals, percentiles and grouped sums of a storage amount column of the snapshot,
+# rows (a boolean array over the DMPs) restricts the DMPs taken into account
+# a DMP in several groups (e.g. two faculties) counts fully in each of them
+def get_capacity(snapshot, field, rows=None):
+    amounts = np.asarray(snapshot.columns[field + "_bytes"])
+    known = ~np.isnan(amounts)
+    if rows is not None:
+        known &= rows
+    amounts = np.where(known, amounts, 0)
+    result = {
+        "count": int(known.sum()),
+        "total_bytes": int(amounts.sum()),
+        "percentiles": {
+            str(percentile): int(value)
+            for percentile, value in zip(
+                PERCENTILES,
+                np.percentile(amounts[known], PERCENTILES) if known.any() else [],
+            )
+        },
+    }
+    for question, name in CAPACITY_GROUPS:
+        codes = snapshot.columns[question + ".codes"]
+        positions = snapshot.rows(question)
+        size = len(snapshot.dictionaries[question])
+        totals = np.bincount(codes, weights=amounts[positions], minlength=size)
+        counts = np.bincount(codes, weights=known[positions], minlength=size)
+        result[name] = [
+            (value, int(total), int(count))
+            for value, total, count in zip(
+                snapshot.dictionaries[question], totals, counts
+            )
+            if count
+        ]
+    return result
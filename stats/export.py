@@ -0,0 +1,121 @@
+import csv
+import json
+import tempfile
+from collections import defaultdict
+from itertools import islice
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from stats.aggregates import AGGREGATES
+from stats.models import DMP
+
+CHUNK_SIZE = 2000
+
+FIELDS = (
+    "dmp_id",
+    "type",
+    "template_name",
+    "human_participants",
+    "personal_data",
+    "confidential_data",
+    "data_amount",
+    "data_amount_public",
+    "data_amount_bytes",
+    "data_amount_public_bytes",
+    "data_amount_open_ended",
+    "data_amount_public_open_ended",
+    "created",
+    "last_updated",
+)
+
+# exported column: lookup of the values
+MULTI_VALUED = (
+    ("storage_locations", "storage_locations__name"),
+    ("data_types_public", "data_types_public__name"),
+    ("share_types", "share_types__name"),
+    ("faculty_departments", "researchers__faculty_department__name"),
+)
+
+
+# same semantics as the filter form: OR within a question, AND across questions
+# every question is a subquery, so filtering on multi-valued questions never multiplies rows
+def filter_dmps(filters):
+    questions = dict(AGGREGATES)
+    queryset = DMP.objects.all()
+    for question, searches in filters.items():
+        if question not in questions:
+            continue
+        qs = Q()
+        for search in searches:
+            if search != "None":
+                qs |= Q(**{question + "__in": [search]})
+            else:
+                qs |= Q(**{question + "__isnull": True})
+        queryset = queryset.filter(pk__in=DMP.objects.filter(qs).values("pk"))
+    return queryset
+
+
+# yields one dict per DMP, the multi-valued questions are fetched per chunk of DMPs
+# (from the database of the queryset) so memory stays flat regardless of the
+# number of rows
+def export_rows(queryset, chunk_size=CHUNK_SIZE):
+    rows = (
+        queryset.order_by("pk")
+        .values_list("pk", *FIELDS)
+        .iterator(chunk_size=chunk_size)
+    )
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        pks = [row[0] for row in chunk]
+        values = {name: defaultdict(list) for name, lookup in MULTI_VALUED}
+        for name, lookup in MULTI_VALUED:
+            members = (
+                DMP.objects.using(queryset.db)
+                .filter(pk__in=pks, **{lookup + "__isnull": False})
+                .order_by("pk", lookup)
+                .values_list("pk", lookup)
+                .distinct()
+            )
+            for pk, value in members:
+                values[name][pk].append(value)
+        for row in chunk:
+            item = dict(zip(FIELDS, row[1:]))
+            for name, lookup in MULTI_VALUED:
+                item[name] = values[name][row[0]]
+            yield item
+
+
+# file-like object that hands back what is written, for csv.writer
+class Echo:
+    def write(self, value):
+        return value
+
+
+def export_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow([*FIELDS, *[name for name, lookup in MULTI_VALUED]])
+    for row in rows:
+        yield writer.writerow(
+            [
+                *[row[field] for field in FIELDS],
+                *["; ".join(row[name]) for name, lookup in MULTI_VALUED],
+            ]
+        )
+
+
+def export_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + "\n"
+
+
+# the exported lines in a temporary file (on disk, so memory stays flat), rewound
+# to be served from
+def spool(lines):
+    out = tempfile.TemporaryFile()
+    for line in lines:
+        out.write(line.encode())
+    out.seek(0)
+    return out
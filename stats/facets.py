@@ -0,0 +1,117 @@
+import threading
+
+import numpy as np
+
+from stats.aggregates import AGGREGATES
+from stats.cache import get_data_version
+from stats.snapshot import Snapshot, load_snapshot
+
+# number of set bits in every possible byte
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(bits):
+    return int(POPCOUNT[bits].sum(dtype=np.int64))
+
+
+# one packed bitset per (question, value) over the DMP row positions,
+# filtering is OR within a question and AND across questions
+class FacetIndex:
+    def __init__(self, size):
+        self.size = size
+        self.everything = np.packbits(np.ones(size, dtype=bool))
+        self.nothing = np.packbits(np.zeros(size, dtype=bool))
+        self.facets = {question[0]: {} for question in AGGREGATES}
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        index = cls(snapshot.size)
+        for question in AGGREGATES:
+            codes = snapshot.columns[question[0] + ".codes"]
+            rows = snapshot.rows(question[0])
+            for code, value in enumerate(snapshot.dictionaries[question[0]]):
+                bits = np.zeros(snapshot.size, dtype=bool)
+                bits[rows[codes == code]] = True
+                index.facets[question[0]][value] = np.packbits(bits)
+        return index
+
+    # filters: {question: [values as sent by the filter form]}
+    def mask(self, filters):
+        mask = self.everything
+        for question, searches in filters.items():
+            if question not in self.facets:
+                continue
+            selected = self.nothing
+            for value, bits in self.facets[question].items():
+                if str(value) in searches:
+                    selected = selected | bits
+            mask = mask & selected
+        return mask
+
+    # the mask as one boolean per DMP row
+    def rows(self, mask):
+        return np.unpackbits(mask, count=self.size).astype(bool)
+
+    # returns {question: [(value, total), ...]} like compute_aggregates()
+    def counts(self, mask=None):
+        if mask is None:
+            mask = self.everything
+        aggregates = {}
+        for question, values in self.facets.items():
+            aggregates[question] = []
+            for value, bits in values.items():
+                total = popcount(bits & mask)
+                if total:
+                    aggregates[question].append((value, total))
+        return aggregates
+
+    # contingency table of two questions: [(row value, [(col value, total), ...]), ...]
+    # only values that occur within the mask are included
+    def crosstab(self, row, col, mask=None):
+        if mask is None:
+            mask = self.everything
+        col_values = [
+            value for value, bits in self.facets[col].items() if popcount(bits & mask)
+        ]
+        col_bits = np.array(
+            [self.facets[col][value] for value in col_values], dtype=np.uint8
+        ).reshape(len(col_values), len(mask))
+        table = []
+        for value, bits in self.facets[row].items():
+            row_bits = bits & mask
+            if not popcount(row_bits):
+                continue
+            totals = POPCOUNT[col_bits & row_bits].sum(axis=1, dtype=np.int64)
+            table.append((value, list(zip(col_values, totals.tolist()))))
+        return table
+
+
+_lock = threading.RLock()
+_snapshot = None
+_index = None
+
+
+# the memory-mapped snapshot written by fetch, before the first snapshot
+# every worker builds one from the database (once per data version)
+def get_snapshot():
+    global _snapshot
+    snapshot = load_snapshot()
+    if snapshot:
+        return snapshot
+    version = get_data_version()
+    with _lock:
+        if _snapshot is None or _snapshot.version != version:
+            _snapshot = Snapshot.from_database(version)
+        return _snapshot
+
+
+# every worker keeps its own index and rebuilds it for every new snapshot,
+# pass the snapshot when its columns are used with the index, a new snapshot
+# may replace the current one in between
+def get_facet_index(snapshot=None):
+    global _index
+    snapshot = snapshot or get_snapshot()
+    with _lock:
+        if _index is None or _index[0] != snapshot.version:
+            _index = (snapshot.version, FacetIndex.from_snapshot(snapshot))
+        return _index[1]
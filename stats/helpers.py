@@ -60,6 +60,41 @@ def clean_html(raw_html):
     return clean_text
 
 
+STORAGE_UNITS = {
+    "B": 1,
+    "KB": 10 ** 3,
+    "MB": 10 ** 6,
+    "GB": 10 ** 9,
+    "TB": 10 ** 12,
+    "PB": 10 ** 15,
+}
+
+
+# normalises a storage amount answer to bytes: "< 250 GB" and "250 GB - 5 TB" give
+# their upper bound, open-ended answers like "> 5 TB" give their lower bound (see
+# is_open_ended(), which keeps them apart from the range ending there)
+def parse_storage_amount(text):
+    if not text:
+        return None
+    amounts = re.findall(r"(\d+(?:[.,]\d+)?)\s*([KMGTP]?B)\b", text.upper())
+    if not amounts:
+        return None
+    number, unit = amounts[0] if is_open_ended(text) else amounts[-1]
+    return int(float(number.replace(",", ".")) * STORAGE_UNITS[unit])
+
+
+# "> 5 TB" has no upper bound, its amount is only the lower bound
+def is_open_ended(text):
+    return bool(text) and text.strip().startswith(">")
+
+
+# log-scale histogram bin of a storage amount: floor(log2(bytes))
+def get_storage_bucket(amount):
+    if not amount:
+        return None
+    return amount.bit_length() - 1
+
+
 def get_md5(text):
     result = hashlib.md5(text.encode())
     return result.hexdigest()
@@ -0,0 +1,120 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from stats.models import RunLease
+
+logger = logging.getLogger("main")
+
+WAIT_INTERVAL = 10  # seconds between attempts of acquire(wait=True)
+
+
+# a named lease row held by one process at a time, so a fetch can't overlap
+# with another one; a thread renews it every third of RUN_LEASE_SECONDS and
+# a lease that wasn't renewed in time is stale, its holder probably died
+# the processes of one group (the shards of a batch) share the lease, it is
+# released when the last of them releases it
+class Lease:
+    def __init__(self, name, seconds=None, group=None):
+        self.name = name
+        self.seconds = seconds or settings.RUN_LEASE_SECONDS
+        self.group = group
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+        self.thread = threading.Thread(target=self.renew_periodically, daemon=True)
+
+    # steal takes over a stale lease, wait retries until the lease is free (or
+    # stale, a lease is only stale once its holders stopped renewing it)
+    def acquire(self, steal=True, wait=False):
+        while not self.try_acquire(steal):
+            current = RunLease.objects.filter(name=self.name).first()
+            if current is None:
+                continue  # released in the meantime
+            stale = current.expires < timezone.now()
+            logger.warning(
+                f"Lease {self.name} is held by {current.holder}"
+                + (f" for {current.group}" if current.group else "")
+                + f" since {current.acquired}, last heartbeat {current.heartbeat}"
+                + (" (stale)" if stale else "")
+            )
+            if not wait:
+                return False
+            time.sleep(WAIT_INTERVAL)
+        self.thread.start()
+        return True
+
+    def try_acquire(self, steal):
+        now = timezone.now()
+        fields = {
+            "holder": self.holder,
+            "run": None,
+            "acquired": now,
+            "heartbeat": now,
+            "expires": now + timedelta(seconds=self.seconds),
+            "group": self.group,
+            "holders": 1,
+        }
+        try:
+            with transaction.atomic():
+                RunLease.objects.create(name=self.name, **fields)
+            return True
+        except IntegrityError:
+            if self.group and RunLease.objects.filter(
+                name=self.name, group=self.group
+            ).update(
+                holders=F("holders") + 1, heartbeat=now, expires=fields["expires"]
+            ):
+                logger.info(f"Joined the lease {self.name} for {self.group}")
+                return True
+            if steal and RunLease.objects.filter(
+                name=self.name, expires__lt=now
+            ).update(**fields):
+                logger.warning(f"Took over the stale lease {self.name}")
+                return True
+        return False
+
+    # the lease row of this process, or of its group
+    def mine(self):
+        if self.group:
+            return RunLease.objects.filter(name=self.name, group=self.group)
+        return RunLease.objects.filter(name=self.name, holder=self.holder)
+
+    def set_run(self, run):
+        self.mine().update(run=run)
+
+    # False once another process took the lease over
+    def renew(self):
+        now = timezone.now()
+        renewed = self.mine().update(
+            heartbeat=now, expires=now + timedelta(seconds=self.seconds)
+        )
+        if not renewed:
+            logger.error(f"Lost the lease {self.name} to another process")
+            self.lost.set()
+        return bool(renewed)
+
+    def renew_periodically(self):
+        try:
+            while not self.stopped.wait(self.seconds / 3):
+                if not self.renew():
+                    break
+        finally:
+            connection.close()
+
+    def release(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        # a process of the group joining in between keeps the row
+        self.mine().update(holders=F("holders") - 1)
+        self.mine().filter(holders__lte=0).delete()
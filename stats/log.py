@@ -0,0 +1,60 @@
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+# attributes every LogRecord has, anything else was passed with extra={...}
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+# one JSON object per line, for log shippers; extra={...} fields are included
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+# unlike the stdlib QueueHandler this doesn't format in the logging thread,
+# the message is only merged with its arguments, the listener does the rest
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# moves the handlers of the given loggers behind one queue, a listener thread
+# formats and writes the records so logging never blocks on stdout, stop the
+# returned listener to flush them
+def queue_loggers(names):
+    handlers = []
+    for name in names:
+        for handler in logging.getLogger(name).handlers:
+            if handler not in handlers:
+                handlers.append(handler)
+    if not handlers:
+        return None
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    queue_handler = DeferredQueueHandler(records)
+    for name in names:
+        logging.getLogger(name).handlers = [queue_handler]
+    return listener
@@ -0,0 +1,33 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from stats.export import export_csv, export_ndjson, export_rows, filter_dmps
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("-f", "--format", choices=("csv", "ndjson"), default="csv")
+        parser.add_argument("-o", "--output", type=str)
+        # same names and values as the filter form, e.g. -q personal_data=True
+        parser.add_argument("-q", "--filter", action="append", default=[])
+
+    def handle(self, *args, **options):
+        filters = {}
+        for item in options["filter"]:
+            question, value = item.split("=", 1)
+            filters.setdefault(question, []).append(value)
+
+        rows = export_rows(filter_dmps(filters))
+        lines = export_csv(rows) if options["format"] == "csv" else export_ndjson(rows)
+        out = (
+            open(options["output"], "w", newline="")
+            if options["output"]
+            else sys.stdout
+        )
+        try:
+            for line in lines:
+                out.write(line)
+        finally:
+            if out is not sys.stdout:
+                out.close()
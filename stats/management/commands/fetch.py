@@ -1,20 +1,46 @@
 import json
 import logging
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.core.mail import send_mail
-
-from stats.helpers import get_md5
+from django.utils import timezone
+
+from stats.aggregates import rebuild_aggregates, rebuild_rollups
+from stats.cache import bump_data_version
+from stats.helpers import (
+    get_datetime,
+    get_md5,
+    get_storage_bucket,
+    is_open_ended,
+    parse_storage_amount,
+)
+from stats.leases import Lease
+from stats.mapping_pool import map_plan, mapping_pool
 from stats.mappings import Mappings, AvgRegistry, ESBConnection, SharePointConn
+from stats.metrics import metrics
+from stats.profiling import MemoryTracer, profile
+from stats.progress import Progress
+from stats.sharding import (
+    get_batch_run,
+    lease_plan,
+    merge_shards,
+    parse_shard,
+    shard_pages,
+)
 from stats.models import (
     DMP,
-    DataUser,
     DataType,
     ShareType,
     StorageLocation,
     FacultyDepartment,
+    Researcher,
+    SyncRun,
 )
+from stats.snapshot import write_snapshot
 
 logger = logging.getLogger("main")
 
@@ -23,166 +49,358 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("-b", "--begin", type=int)
         parser.add_argument("-e", "--end", type=int)
+        parser.add_argument(
+            "--profile",
+            nargs="?",
+            const="fetch-profile",
+            metavar="PREFIX",
+            help="write a profile to PREFIX.txt, PREFIX.pstats and PREFIX.folded",
+        )
+        parser.add_argument(
+            "--trace-memory",
+            action="store_true",
+            help="log the top allocators and peak memory after every page",
+        )
+        parser.add_argument(
+            "--progress-interval",
+            type=int,
+            default=60,
+            help="seconds between progress reports (also sent on SIGUSR1)",
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            default=settings.MAPPING_WORKERS,
+            help="processes mapping the plans, 0 maps them in this process",
+        )
+        parser.add_argument(
+            "--shard",
+            type=parse_shard,
+            metavar="K/N",
+            help="only fetch every Nth page of the range, starting at the Kth",
+        )
+        parser.add_argument(
+            "--batch",
+            help="name shared by the N shards (default: the date and page range)",
+        )
+        parser.add_argument(
+            "--if-running",
+            choices=["skip", "wait"],
+            default="skip",
+            help="what to do when another fetch (or a sync_daemon poll) is running,"
+            " a lease its holder stopped renewing is taken over either way",
+        )
 
     def handle(self, *args, **options):
         # begin and end ints are for pages
         # requested from DMP online
         begin = options["begin"] if options["begin"] else 267
         end = options["end"] if options["end"] else 269
+        # one fetch (or sync_daemon poll) at a time, the shards of one batch
+        # share the lease, see stats.leases
+        group = None
+        if options["shard"]:
+            group = options["batch"] = (
+                options["batch"] or f"{timezone.localdate()} pages {begin}-{end}"
+            )
+        self.lease = Lease("fetch", group=group)
+        if not self.lease.acquire(wait=options["if_running"] == "wait"):
+            logger.info("Skipping this fetch")
+            return
+        try:
+            self.run_fetch(begin, end, options)
+        finally:
+            self.lease.release()
+
+    def run_fetch(self, begin, end, options):
         logger.info(f"Fetching from page {begin} to {end}")
-        dj_avg_del = (
-            sp_avg_del
-        ) = (
-            stats_avg_del
-        ) = (
-            dj_avg_ins
-        ) = (
-            dj_avg_upd
-        ) = (
-            sp_avg_ins
-        ) = (
-            sp_avg_upd
-        ) = (
-            dj_avg_fail
-        ) = (
-            sp_avg_fail
-        ) = stats_ins = total_dmps = mappable_dmps = td_ins = td_ins_ok = 0
+        pages = range(begin, end)
+        batch = shard = None
+        if options["shard"]:
+            shard, count = options["shard"]
+            pages = shard_pages(begin, end, shard, count)
+            batch = get_batch_run(options["batch"], begin, end, count)
+            logger.info(f"Shard {shard}/{count} of batch {batch.batch}: pages {pages}")
+        # run.counters: dj_avg_del, sp_avg_del, stats_avg_del, dj_avg_ins, dj_avg_upd,
+        # sp_avg_ins, sp_avg_upd, dj_avg_fail, sp_avg_fail, stats_ins, total_dmps,
+        # mappable_dmps, td_ins and td_ins_ok, also written to the metrics file
+        run = SyncRun.objects.create(
+            begin_page=begin,
+            end_page=end,
+            counters=Counter(),
+            stage_seconds=Counter(),
+            parent=batch,
+            shard=shard,
+        )
+        self.lease.set_run(batch or run)
+        self.memory = MemoryTracer() if options["trace_memory"] else None
+        self.progress = Progress(run, len(pages), options["progress_interval"])
+        self.progress.start()
+        self.pool = mapping_pool(options["workers"]) if options["workers"] else None
+        try:
+            with profile(options["profile"]) if options["profile"] else nullcontext():
+                self.fetch(run, pages)
+        except BaseException:
+            finish_run(run, SyncRun.FAILED)
+            raise
+        else:
+            finish_run(run, SyncRun.FINISHED)
+        finally:
+            if self.pool:
+                self.pool.shutdown(cancel_futures=True)
+            if self.memory:
+                self.memory.stop()
+            # the last shard publishes the statistics of the batch, kill -USR1
+            # still reports progress (and doesn't kill it) meanwhile
+            try:
+                if batch:
+                    finish_batch(run)
+            finally:
+                self.progress.stop()
+
+    def fetch(self, run, pages):
+        counters = run.counters
         # get all existing AVG register lines
         logger.info("Getting all AVG register lines...")
         avg_register = AvgRegistry().get_all().json()
         logger.info(f"Found {len(avg_register)} AVG lines")
 
+        # one authenticated connection to DMPonline for all pages
+        dmponline = Mappings()
+
         # get all existing DMP ids
         logger.info("Getting all DMP ids from DMPonline...")
-        all_plan_ids = Mappings().get_all_plan_ids()
+        all_plan_ids = dmponline.get_all_plan_ids()
         logger.info(f"Found {len(all_plan_ids)} plan ids")
 
-        # check if AVG line is still in DMPonline,
-        # else remove AVG line and remove from stats
-        for avg_line in avg_register:
-            if int(avg_line["sourcekey"]) not in all_plan_ids:
-                logger.info(
-                    f"Deleting AVG line {avg_line['avgregisterline']['id']} (DMP id {avg_line['sourcekey']})"
-                    f" from registry and statistics..."
-                )
-                e, a = AvgRegistry().remove_record(
-                    avg_line["sourcekey"], avg_line["avgregisterline"]["id"]
-                )
-                dj_avg_del += 1
-                if e.status_code == a.status_code == 204:
-                    logger.info(
-                        f"Succesfully deleted DMP with id {avg_line['sourcekey']}"
-                    )
-                else:
-                    logger.info(f"{e.status_code}, {a.status_code}, {e.text}, {a.text}")
-                n = DMP.objects.filter(dmp_id=avg_line["sourcekey"]).delete()
-                stats_avg_del += 1
-                logger.info(f"Deleted {n} items from stats.")
-
-                # TODO: delete AVG line from SharePoint, as of now,
-                #  we don't have a reference to corresponding SharePoint ID
-
-        for i in range(begin, end):  # 69, 269
+        # of a batch, only the first shard deletes
+        if run.shard in (None, 1):
+            remove_deleted_plans(run, avg_register, all_plan_ids)
+
+        for i in pages:  # 69, 269
+            if self.lease.lost.is_set():
+                raise CommandError("Another fetch took over the lease")
             logger.info(f"Page {i}")
 
             # get all 10 DMPs from this page
-            page = Mappings().get_page(i)
-
-            for item in page:
-                total_dmps += 1
-                plan = Mappings()
-                is_updated = is_inserted = False
-
-                plan.set_plan_by_dict(item)  # sets plan.plan
-                if plan.is_mappable() and not (
-                    plan.is_test_plan() if not settings.PARSE_TEST_PLANS else False
-                ):
-                    mappable_dmps += 1
-                    # uses all the functions in mappings to decide
-                    # on mappings
-                    avg_mappings = plan.get_avg_mappings()
-                    logger.info(f"Found plan {str(plan.get_id())}")
-                    avg_line = plan_in_avg_register(plan, avg_register)
-
-                    logger.info(
-                        f"Inserting {plan.get_id()} into SharePoint AVG list..."
-                    )
-                    sp_inserted = SharePointConn().insert_avg_line(
-                        plan.get_sp_avg_mappings()
-                    )
-                    if sp_inserted:
-                        sp_avg_ins += 1
-                        logger.info("Inserting into SharePoint: OK")
-                    # TODO: We need a reference to the corresponding SharePoint AVG line
-                    #  otherwise we would just keep adding already existing lines
-                    else:
-                        sp_avg_fail += 1
-
-                    if avg_line:
-                        # plan is already in AVG registry
-                        # update it anyway (AVG reg. has no last updated)
-                        is_updated = update_avg_register(
-                            avg_mappings, avg_line["avgregisterline"]["id"]
-                        )
-                        if is_updated:
-                            dj_avg_upd += 1
-                        else:
-                            dj_avg_fail += 1
-                        # TODO: We need a reference to the corresponding SharePoint AVG line
-                        #  otherwise we would just keep adding already existing lines
-                    else:  # plan should be inserted into AVG registry
-                        is_inserted = insert_avg_register(avg_mappings)
-                        if is_updated:
-                            dj_avg_ins += 1
-                        else:
-                            dj_avg_fail += 1
-
-                    # esb = ESBConnection()
-                    # logger.info("Creating TOPdesk ticket for storage")
-                    # td_ins += 1
-                    # r = esb.create_topdesk_ticket(plan.get_esb_mappings())
-                    # logger.info(r.status_code)
-                    # if r.status_code == 200:
-                    #    td_ins_ok += 1
-                    # TODO: TOPdesk tickets should only be created when corresponding checkbox
-                    #  is ticked and the plan is new. This is something to decide on because most
-                    #  plans have a difference between date_created and date_last_updated
-
-                    # now get faculty/dep. info from ESB and insert into (anonymous stats DB)
-                    if is_inserted or is_updated:
-                        insert_statistics(plan)
-                        stats_ins += 1
-                    else:
-                        # report_raw_insert(avg_mappings)  # this is dirty, because sometimes it works
-                        # and then, no external ref is added.
-                        send_mail(
-                            "Updating or inserting into AVG registry failed",
-                            "Updating or inserting into AVG registry failed for DMP id"
-                            + str(plan.get_id()),
-                            settings.DEFAULT_FROM_EMAIL,
-                            [settings.DEFAULT_RECIPIENT],
-                            fail_silently=False,
-                        )
-
-                    if plan.key_error_occurred is False:
-                        logger.info("No key errors occurred " + str(plan.get_id()))
-
-                    logger.info("Done processing " + str(plan.get_id()))
-                    """dj_avg_del = sp_avg_del = stats_avg_del = dj_avg_ins = dj_avg_upd = sp_avg_ins = sp_avg_upd = \
-                        dj_avg_fail = sp_avg_fail = stats_ins = total_dmps = mappable_dmps = td_ins = td_ins_ok = 0"""
-        logger.info(f"Total DMPs found: {total_dmps}")
-        logger.info(f"Total mappable DMPs: {mappable_dmps}")
-        logger.info(f"Django AVG lines inserted: {dj_avg_ins}")
-        logger.info(f"Django AVG lines updated: {dj_avg_upd}")
-        logger.info(f"Django AVG lines failed (ins/upd): {dj_avg_fail}")
-        logger.info(f"SharePoint AVG lines inserted: {sp_avg_ins}")
-        logger.info(f"SharePoint AVG lines failed: {sp_avg_fail}")
-        logger.info(f"Statistics lines inserted {stats_ins}")
-        logger.info(f"Django AVG lines deleted: {dj_avg_del}")
-        logger.info(f"Statistics lines deleted: {stats_avg_del}")
-
-
-def plan_in_avg_register(plan, avg_register):
+            with timed_stage(run, "fetch"):
+                page = dmponline.get_page(i)
+            if run.shard:
+                leased = [item for item in page if lease_plan(run, item["id"])]
+                counters["leased_dmps"] += len(page) - len(leased)
+                page = leased
+
+            for mapping in map_plans(run, self.pool, page):
+                process_plan(run, mapping, avg_register)
+            save_progress(run)
+            self.progress.page_done()
+            if self.memory:
+                self.memory.snapshot(f"page {i}")
+        log_counters(counters)
+        # a batch is published by its last shard, see finish_batch
+        if not run.shard:
+            publish_statistics()
+
+
+# check if AVG line is still in DMPonline,
+# else remove AVG line and remove from stats
+def remove_deleted_plans(run, avg_register, all_plan_ids):
+    counters = run.counters
+    for avg_line in avg_register:
+        if int(avg_line["sourcekey"]) not in all_plan_ids:
+            logger.info(
+                f"Deleting AVG line {avg_line['avgregisterline']['id']} (DMP id {avg_line['sourcekey']})"
+                f" from registry and statistics..."
+            )
+            e, a = AvgRegistry().remove_record(
+                avg_line["sourcekey"], avg_line["avgregisterline"]["id"]
+            )
+            counters["dj_avg_del"] += 1
+            if e.status_code == a.status_code == 204:
+                logger.info(f"Succesfully deleted DMP with id {avg_line['sourcekey']}")
+            else:
+                logger.info(f"{e.status_code}, {a.status_code}, {e.text}, {a.text}")
+            n = DMP.objects.filter(dmp_id=avg_line["sourcekey"]).delete()
+            counters["stats_avg_del"] += 1
+            logger.info(f"Deleted {n} items from stats.")
+
+            # TODO: delete AVG line from SharePoint, as of now,
+            #  we don't have a reference to corresponding SharePoint ID
+
+
+# the plans of a page mapped in the pool (in order, each as soon as it is done)
+# or in this process, the time spent waiting for them is the map stage
+def map_plans(run, pool, page):
+    mappings = pool.map(map_plan, page) if pool else map(map_plan, page)
+    for _ in page:
+        with timed_stage(run, "map"):
+            mapping = next(mappings)
+        yield mapping
+
+
+# sends one mapped plan (see map_plan) to the AVG registry and SharePoint and
+# writes its statistics, returns whether the plan was mapped
+def process_plan(run, mapping, avg_register):
+    counters = run.counters
+    counters["total_dmps"] += 1
+    if mapping is None:
+        return False
+    counters["mappable_dmps"] += 1
+    is_updated = is_inserted = False
+    plan_id = mapping["id"]
+    avg_mappings = mapping["avg"]
+    logger.debug(f"Found plan {plan_id}")
+
+    logger.debug(f"Inserting {plan_id} into SharePoint AVG list...")
+    with timed_stage(run, "sharepoint"):
+        sp_inserted = SharePointConn().insert_avg_line(mapping["sharepoint"])
+    if sp_inserted:
+        counters["sp_avg_ins"] += 1
+        logger.debug("Inserting into SharePoint: OK")
+    # TODO: We need a reference to the corresponding SharePoint AVG line
+    #  otherwise we would just keep adding already existing lines
+    else:
+        counters["sp_avg_fail"] += 1
+
+    with timed_stage(run, "avg"):
+        avg_line = plan_in_avg_register(plan_id, avg_register)
+        if avg_line:
+            # plan is already in AVG registry
+            # update it anyway (AVG reg. has no last updated)
+            is_updated = update_avg_register(
+                avg_mappings, avg_line["avgregisterline"]["id"]
+            )
+            if is_updated:
+                counters["dj_avg_upd"] += 1
+            else:
+                counters["dj_avg_fail"] += 1
+            # TODO: We need a reference to the corresponding SharePoint AVG line
+            #  otherwise we would just keep adding already existing lines
+        else:  # plan should be inserted into AVG registry
+            is_inserted = insert_avg_register(avg_mappings)
+            if is_inserted:
+                counters["dj_avg_ins"] += 1
+            else:
+                counters["dj_avg_fail"] += 1
+
+    # esb = ESBConnection()
+    # logger.info("Creating TOPdesk ticket for storage")
+    # counters["td_ins"] += 1
+    # r = esb.create_topdesk_ticket(plan.get_esb_mappings())
+    # logger.info(r.status_code)
+    # if r.status_code == 200:
+    #    counters["td_ins_ok"] += 1
+    # TODO: TOPdesk tickets should only be created when corresponding checkbox
+    #  is ticked and the plan is new. This is something to decide on because most
+    #  plans have a difference between date_created and date_last_updated
+
+    # now get faculty/dep. info from ESB and insert into (anonymous stats DB)
+    if is_inserted or is_updated:
+        with timed_stage(run, "stats"):
+            insert_statistics(mapping["stats"])
+        counters["stats_ins"] += 1
+    else:
+        # report_raw_insert(avg_mappings)  # this is dirty, because sometimes it works
+        # and then, no external ref is added.
+        send_mail(
+            "Updating or inserting into AVG registry failed",
+            "Updating or inserting into AVG registry failed for DMP id"
+            + str(plan_id),
+            settings.DEFAULT_FROM_EMAIL,
+            [settings.DEFAULT_RECIPIENT],
+            fail_silently=False,
+        )
+
+    if mapping["key_error_occurred"] is False:
+        logger.debug("No key errors occurred " + str(plan_id))
+
+    logger.debug("Done processing " + str(plan_id))
+    return True
+
+
+def log_counters(counters):
+    logger.info(f"Total DMPs found: {counters['total_dmps']}")
+    logger.info(f"Total mappable DMPs: {counters['mappable_dmps']}")
+    logger.info(f"Django AVG lines inserted: {counters['dj_avg_ins']}")
+    logger.info(f"Django AVG lines updated: {counters['dj_avg_upd']}")
+    logger.info(f"Django AVG lines failed (ins/upd): {counters['dj_avg_fail']}")
+    logger.info(f"SharePoint AVG lines inserted: {counters['sp_avg_ins']}")
+    logger.info(f"SharePoint AVG lines failed: {counters['sp_avg_fail']}")
+    logger.info(f"Statistics lines inserted {counters['stats_ins']}")
+    logger.info(f"Django AVG lines deleted: {counters['dj_avg_del']}")
+    logger.info(f"Statistics lines deleted: {counters['stats_avg_del']}")
+
+
+# the dashboard reads the aggregates, rollups and snapshot, not the DMP rows
+def publish_statistics():
+    logger.info("Rebuilding dashboard aggregates...")
+    rebuild_aggregates()
+    rebuild_rollups()
+    version = bump_data_version()
+    logger.info(f"Data version is now {version}")
+    write_snapshot(version)
+
+
+# times a stage (of one plan, or the request of a page for "fetch")
+# into the metrics and the wall time per stage of the run
+@contextmanager
+def timed_stage(run, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe("dmps_plan_stage_seconds", seconds, stage=stage)
+        run.stage_seconds[stage] += seconds
+
+
+# the run counters and timings so far, for the run history and the metrics view
+def save_progress(run):
+    run.save(update_fields=["counters", "stage_seconds"])
+    write_metrics(run)
+
+
+def write_metrics(run):
+    for name, value in run.counters.items():
+        metrics.set("dmps_fetch_run_events", value, event=name)
+    metrics.write()
+
+
+def finish_run(run, status):
+    run.status = status
+    run.finished = timezone.now()
+    seconds = (run.finished - run.started).total_seconds()
+    run.plans_per_second = run.counters["total_dmps"] / seconds if seconds else None
+    run.save()
+    write_metrics(run)
+    # the per-plan messages are debug, this is the summary of the whole run
+    logger.info(
+        f"Run {status}, {run.plans_per_second or 0:.2f} plans per second",
+        extra={
+            "run": run.pk,
+            "status": status,
+            "counters": dict(run.counters),
+            "stage_seconds": dict(run.stage_seconds),
+        },
+    )
+
+
+# the last shard of a batch to finish sums the counters of all shards into the
+# batch run and publishes the statistics
+def finish_batch(run):
+    batch = merge_shards(run)
+    if batch is None:
+        return
+    failed = batch.shards.filter(status=SyncRun.FAILED).exists()
+    logger.info(f"Last shard of batch {batch.batch} done")
+    log_counters(batch.counters)
+    if not failed:
+        publish_statistics()
+    finish_run(batch, SyncRun.FAILED if failed else SyncRun.FINISHED)
+
+
+def plan_in_avg_register(plan_id, avg_register):
     for avg_line in avg_register:
         try:
             avg_source_key = avg_line["sourcekey"]
@@ -192,15 +410,15 @@ def plan_in_avg_register(plan, avg_register):
             avg_source_key = None
         if avg_source_key:
             avg_source_key = int(avg_source_key)
-        if avg_source_key == plan.get_id():
-            logger.info(f"Found avg_line {str(avg_line['avgregisterline']['id'])}")
+        if avg_source_key == plan_id:
+            logger.debug(f"Found avg_line {str(avg_line['avgregisterline']['id'])}")
             return avg_line
 
 
 def update_avg_register(avg_mappings, avg_id):
     result = AvgRegistry().update_record(avg_mappings, avg_id=avg_id)
     if result.status_code == 200:  # updated
-        logger.info("AVG registry updated in update_avg_register()")
+        logger.debug("AVG registry updated in update_avg_register()")
         return True
     else:
         logger.error("AVG registry update FAILED")
@@ -211,7 +429,7 @@ def update_avg_register(avg_mappings, avg_id):
 def insert_avg_register(avg_mappings):
     result = AvgRegistry().insert_record(avg_mappings)
     if result.status_code == 201:  # created
-        logger.info("Inserted into AVG registry")
+        logger.debug("Inserted into AVG registry")
         return True
     elif result.status_code == 200:  # updated
         logger.warning(
@@ -233,67 +451,87 @@ def insert_avg_register(avg_mappings):
         return False
 
 
-def insert_statistics(plan):
+# many plans do not answer the storage questions, those stay None
+def set_storage_amounts(dmp, answer, public_answer):
+    dmp.data_amount_bytes = parse_storage_amount(answer)
+    dmp.data_amount_public_bytes = parse_storage_amount(public_answer)
+    dmp.data_amount_open_ended = is_open_ended(answer)
+    dmp.data_amount_public_open_ended = is_open_ended(public_answer)
+    dmp.data_amount_bucket = get_storage_bucket(dmp.data_amount_bytes)
+    dmp.data_amount_public_bucket = get_storage_bucket(dmp.data_amount_public_bytes)
+    # the dashboard still groups the answers in GB
+    dmp.data_amount = (
+        dmp.data_amount_bytes // 10 ** 9 if dmp.data_amount_bytes else None
+    )
+    dmp.data_amount_public = (
+        dmp.data_amount_public_bytes // 10 ** 9
+        if dmp.data_amount_public_bytes
+        else None
+    )
+
+
+# stats are the statistics of a plan, see Mappings.get_stats_mappings()
+def insert_statistics(stats):
     esb = ESBConnection()
     dmp = DMP()
-    dmp.dmp_id = plan.get_id()
+    dmp.dmp_id = stats["dmp_id"]
+    # DMPonline dates are UTC
+    last_updated = timezone.make_aware(
+        get_datetime(stats["last_updated"]), timezone.utc
+    )
     try:
-        logger.info(dmp.dmp_id)
+        logger.debug(dmp.dmp_id)
         dmp = DMP.objects.get(dmp_id=dmp.dmp_id)
-        logger.info("Exists in stats")
+        logger.debug("Exists in stats, updating...")
     except DMP.DoesNotExist:
-        logger.info("Does not exist in stats, adding to stats...")
-        dmp.type = plan.get_template_id()
-        dmp.template_name = plan.get_template_name()
-        dmp.personal_data = plan.has_personal_data()
-        dmp.human_participants = plan.has_human_participants()
+        logger.debug("Does not exist in stats, adding to stats...")
+    # the answers of an updated plan replace the stored ones
+    dmp.last_updated = last_updated
+    dmp.type = stats["type"]
+    dmp.template_name = stats["template_name"]
+    dmp.personal_data = stats["personal_data"]
+    dmp.human_participants = stats["human_participants"]
+    dmp.confidential_data = stats["confidential_data"]
+    # DMPs stored before the creation date was kept get it on their next sync
+    if dmp.created is None:
+        dmp.created = timezone.make_aware(
+            get_datetime(stats["created"]), timezone.utc
+        )
 
-        # many variables are often not filled out
-        try:
-            data_amount = int(plan.get_storage_amount().split(" ")[-2])
-            if data_amount == 5:
-                data_amount *= 1000  # quick and dirty
-            dmp.data_amount = data_amount
-            # TODO: handle > 5 TB option properly
-        except AttributeError:
-            pass
-        dmp.confidential_data = plan.has_confidential_data()
-        try:
-            data_amount_public = int(plan.get_storage_amount_public().split(" ")[-2])
-            if data_amount_public == 1:
-                data_amount_public *= 1000  # quick & dirty
-            dmp.data_amount_public = data_amount_public
-            # TODO: handle > 1 TB option properly
-        except AttributeError:
-            pass
-        dmp.save()
-
-    for data_type in plan.get_data_types():
-        dt, created = DataType.objects.get_or_create(name=data_type)
-        dmp.data_types_public.add(dt)
-
-    for share_type in plan.get_share_types():
-        st, created = ShareType.objects.get_or_create(name=share_type)
-        dmp.share_types.add(st)
-
-    for storage_location in plan.get_storage_locations_stats():
-        sl, created = StorageLocation.objects.get_or_create(name=storage_location)
-        dmp.storage_locations.add(sl)
-
-    for user in plan.plan["users"]:
-        data_user = DataUser()
+    # storage amounts are normalised on every run, so older rows get them too
+    set_storage_amounts(dmp, stats["storage_amount"], stats["storage_amount_public"])
+    dmp.save()
+
+    # answers no longer given are removed as well
+    dmp.data_types_public.set(
+        [DataType.objects.get_or_create(name=name)[0] for name in stats["data_types"]]
+    )
+    dmp.share_types.set(
+        [ShareType.objects.get_or_create(name=name)[0] for name in stats["share_types"]]
+    )
+    dmp.storage_locations.set(
+        [
+            StorageLocation.objects.get_or_create(name=name)[0]
+            for name in stats["storage_locations"]
+        ]
+    )
+
+    researchers = []
+    for email in stats["emails"]:
+        fd = None
 
         # this comes from ESB
-        faculty_department = "-".join(esb.get_department(user["email"]))
+        faculty_department = "-".join(esb.get_department(email))
 
         if faculty_department:
             fd, created = FacultyDepartment.objects.get_or_create(
                 name=faculty_department
             )
-            data_user.faculty_department = fd
 
-        data_user.dmp = dmp
-
-        data_user.email_hash = get_md5(user["email"])
-        data_user.save()
-    logger.info("Successfully added to / updated in stats.")
+        # one row per person, holding their current faculty-department
+        researcher, created = Researcher.objects.update_or_create(
+            email_hash=get_md5(email), defaults={"faculty_department": fd}
+        )
+        researchers.append(researcher)
+    dmp.researchers.set(researchers)
+    logger.debug("Successfully added to / updated in stats.")
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from stats.helpers import print
+from stats.models import DataUser, Researcher
+
+
+# one-off: turns the DataUser rows of older runs into researchers,
+# the most recent row of a person decides their faculty-department
+class Command(BaseCommand):
+    def handle(self, *args, **options):
+        for data_user in DataUser.objects.order_by("pk").iterator():
+            researcher, created = Researcher.objects.update_or_create(
+                email_hash=data_user.email_hash,
+                defaults={"faculty_department": data_user.faculty_department},
+            )
+            researcher.dmps.add(data_user.dmp_id)
+        print(f"{Researcher.objects.count()} researchers")
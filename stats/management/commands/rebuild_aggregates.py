@@ -0,0 +1,8 @@
+from django.core.management.base import BaseCommand
+
+from stats.aggregates import rebuild_aggregates
+
+
+class Command(BaseCommand):
+    def handle(self, *args, **options):
+        rebuild_aggregates()
@@ -0,0 +1,162 @@
+import logging
+import signal
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from stats.helpers import get_datetime
+from stats.management.commands.fetch import (
+    finish_run,
+    log_counters,
+    map_plans,
+    process_plan,
+    publish_statistics,
+    remove_deleted_plans,
+    save_progress,
+    timed_stage,
+)
+from stats.leases import Lease
+from stats.mappings import AvgRegistry, Mappings
+from stats.models import DMP, SyncRun
+
+logger = logging.getLogger("main")
+
+
+# keeps running and polls DMPonline every --interval seconds, only new plans and
+# plans updated since their last sync are mapped, SIGTERM stops it after the
+# plan it is working on
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("-b", "--begin", type=int, default=1)
+        parser.add_argument(
+            "-e", "--end", type=int, help="stop before this page (default: last page)"
+        )
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=settings.SYNC_INTERVAL,
+            help="seconds between polls",
+        )
+        parser.add_argument(
+            "--sweep-every",
+            type=int,
+            default=settings.SYNC_SWEEP_EVERY,
+            help="polls between checks for plans deleted from DMPonline",
+        )
+        parser.add_argument("--once", action="store_true", help="poll once and exit")
+
+    def handle(self, *args, **options):
+        self.stopping = threading.Event()
+        previous = {
+            signum: signal.signal(signum, lambda signum, frame: self.stop())
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        # authenticated once, the requests of all polls share its connections
+        self.dmponline = Mappings()
+        self.avg_register = None
+        polls = 0
+        logger.info(f"Sync daemon polling every {options['interval']} seconds")
+        try:
+            while not self.stopping.is_set():
+                # the database may have closed the connection while we slept
+                close_old_connections()
+                self.poll(
+                    options["begin"],
+                    options["end"],
+                    sweep=polls % options["sweep_every"] == 0,
+                )
+                polls += 1
+                if options["once"]:
+                    break
+                self.stopping.wait(options["interval"])
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+        logger.info("Sync daemon stopped")
+
+    def stop(self):
+        logger.info("Stopping after the current plan...")
+        self.stopping.set()
+
+    def poll(self, begin, end, sweep):
+        # the same lease as fetch, a poll is skipped while a fetch runs
+        lease = Lease("fetch")
+        if not lease.acquire():
+            return
+        run = SyncRun.objects.create(
+            begin_page=begin,
+            end_page=begin,
+            counters=Counter(),
+            stage_seconds=Counter(),
+        )
+        lease.set_run(run)
+        try:
+            self.sync(run, begin, end, sweep)
+        except Exception:
+            # the next poll tries again, a failing downstream shouldn't stop us
+            logger.exception("Poll failed")
+            finish_run(run, SyncRun.FAILED)
+        except BaseException:
+            finish_run(run, SyncRun.FAILED)
+            raise
+        else:
+            finish_run(run, SyncRun.FINISHED)
+        finally:
+            lease.release()
+
+    def sync(self, run, begin, end, sweep):
+        counters = run.counters
+        # the register is only downloaded again after lines were added to it
+        if self.avg_register is None or sweep:
+            self.avg_register = AvgRegistry().get_all().json()
+        if sweep:
+            remove_deleted_plans(
+                run, self.avg_register, self.dmponline.get_all_plan_ids()
+            )
+
+        mapped = 0
+        page_number = begin
+        while not self.stopping.is_set() and (end is None or page_number < end):
+            with timed_stage(run, "fetch"):
+                page = self.dmponline.get_page(page_number)
+            if not page:
+                break
+            changed = changed_plans(page)
+            counters["unchanged_dmps"] += len(page) - len(changed)
+            for mapping in map_plans(run, None, changed):
+                if self.stopping.is_set():
+                    break
+                mapped += process_plan(run, mapping, self.avg_register)
+            run.end_page = page_number
+            save_progress(run)
+            page_number += 1
+
+        if mapped or counters["dj_avg_del"]:
+            log_counters(counters)
+            publish_statistics()
+            self.avg_register = None
+        else:
+            logger.info(f"No changed plans in pages {begin} to {run.end_page}")
+
+
+# the plans of a page that are new or were updated after their last sync
+def changed_plans(page):
+    synced = dict(
+        DMP.objects.filter(dmp_id__in=[item["id"] for item in page]).values_list(
+            "dmp_id", "last_updated"
+        )
+    )
+    changed = []
+    for item in page:
+        plan = Mappings(do_init=False)
+        plan.set_plan_by_dict(item)
+        last_updated = timezone.make_aware(
+            get_datetime(plan.get_last_updated()), timezone.utc
+        )
+        if synced.get(item["id"]) is None or synced[item["id"]] < last_updated:
+            changed.append(item)
+    return changed
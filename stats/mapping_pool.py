@@ -0,0 +1,37 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+
+from stats.mappings import Mappings
+
+
+# a plan dict of a DMPonline page mapped into everything fetch sends or writes:
+# the AVG registry line, the SharePoint AVG item and the statistics, or None
+# for plans that aren't mapped
+def map_plan(item):
+    plan = Mappings(do_init=False)
+    plan.set_plan_by_dict(item)
+    if not plan.is_mappable() or (
+        plan.is_test_plan() if not settings.PARSE_TEST_PLANS else False
+    ):
+        return None
+    return {
+        "id": plan.get_id(),
+        "avg": plan.get_avg_mappings(),
+        "sharepoint": plan.get_sp_avg_mappings(),
+        "stats": plan.get_stats_mappings(),
+        "key_error_occurred": plan.key_error_occurred,
+    }
+
+
+# mapping is CPU bound (BeautifulSoup, walking the plan JSON) and needs no
+# requests or queries, so it can run in other processes; they're spawned,
+# forked workers would share the database connections of the parent
+def mapping_pool(workers):
+    return ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=django.setup,
+    )
@@ -7,6 +7,7 @@ from datetime import datetime
 from requests_ntlm import HttpNtlmAuth
 from django.conf import settings
 from stats.helpers import html_table_to_list, clean_html, remove_special_chars_from_list
+from stats.metrics import Downstream
 
 requests.packages.urllib3.disable_warnings()
 
@@ -22,6 +23,8 @@ MAPPABLE_IDS = (
 
 
 class SharePointConn:
+    http = Downstream("sharepoint")
+
     def __init__(
         self,
         base_url=settings.SHAREPOINT_URL,
@@ -36,7 +39,7 @@ class SharePointConn:
         self.auth = HttpNtlmAuth(username, password)
 
     def get_form_digest_value(self):
-        response = requests.post(
+        response = self.http.post(
             url=self.base_url + "sites/dmponline2avg/avg/_api/contextinfo",
             headers=self.headers,
             auth=self.auth,  # authenticating also yields a token, but
@@ -52,7 +55,7 @@ class SharePointConn:
             "Content-Length": f"{len(json.dumps(sp_avg_line))}",
             "X-RequestDigest": f"{self.get_form_digest_value()}",
         }
-        response = requests.post(
+        response = self.http.post(
             url=self.base_url
             + "sites/dmponline2avg/avg/_api/web/lists/GetByTitle(%27AVG%27)/items",
             headers=headers,
@@ -73,7 +76,7 @@ class SharePointConn:
             "If-Match": "*",  # * means overwrite regardless of version matching (OData standard)
             "X-HTTP-Method": "MERGE",
         }
-        response = requests.post(
+        response = self.http.post(
             url=self.base_url
             + f"sites/dmponline2avg/avg/_api/web/lists/GetByTitle(%27AVG%27)/items({sp_avg_id})",
             headers=headers,
@@ -93,7 +96,7 @@ class SharePointConn:
             "If-Match": "*",  # * means overwrite regardless of version matching (OData standard)
             "X-HTTP-Method": "DELETE",
         }
-        response = requests.post(
+        response = self.http.post(
             url=self.base_url
             + f"sites/dmponline2avg/avg/_api/web/lists/GetByTitle(%27AVG%27)/items({sp_avg_id})",
             headers=headers,
@@ -107,6 +110,7 @@ class SharePointConn:
 
 class ESBConnection:
     verify = True
+    http = Downstream("esb")
 
     def __init__(
         self,
@@ -127,7 +131,7 @@ class ESBConnection:
     def get_department(self, email_address):
         faculty, department = "", ""
         url = self.base_url + "faculty/get?emailAdres=" + email_address
-        df = requests.get(url, headers=self.headers, verify=self.verify).json()
+        df = self.http.get(url, headers=self.headers, verify=self.verify).json()
         try:
             if "organisatieEenheid" in df:
                 elements = df["organisatieEenheid"]["afkortingNLVolledig"].split("-")
@@ -146,12 +150,14 @@ class ESBConnection:
 
     def create_topdesk_ticket(self, esb_mappings):
         url = self.base_url + "storage/request/create"
-        return requests.post(
+        return self.http.post(
             url, headers=self.headers, json=esb_mappings, verify=self.verify
         )
 
 
 class AvgRegistry:
+    http = Downstream("avg_registry")
+
     def __init__(
         self,
         token=settings.AVG_REGISTRY_TOKEN,
@@ -166,7 +172,7 @@ class AvgRegistry:
         }
 
     def insert_record(self, record):
-        return requests.post(
+        return self.http.post(
             url=self.base_url + "avgregisterline/external/",
             headers=self.headers,
             json=record,
@@ -174,7 +180,7 @@ class AvgRegistry:
         )
 
     def update_record(self, record, avg_id):
-        return requests.put(
+        return self.http.put(
             url=self.base_url + f"avgregisterline/{avg_id}/",
             headers=self.headers,
             json=record,
@@ -184,17 +190,17 @@ class AvgRegistry:
     def get_all(
         self,
     ):
-        return requests.get(
+        return self.http.get(
             url=self.base_url + "externals/", headers=self.headers, verify=self.verify
         )
 
     def remove_record(self, dmp_id, avg_id):
-        ext_deleted = requests.delete(
+        ext_deleted = self.http.delete(
             self.base_url + f"externals/{dmp_id}/",
             headers=self.headers,
             verify=self.verify,
         )
-        avg_deleted = requests.delete(
+        avg_deleted = self.http.delete(
             self.base_url + f"avgregisterline/{avg_id}/",
             headers=self.headers,
             verify=self.verify,
@@ -204,6 +210,7 @@ class AvgRegistry:
 
 class Mappings:
     verify = True
+    http = Downstream("dmponline")
 
     def __init__(
         self,
@@ -236,7 +243,7 @@ class Mappings:
                 "code": self.token,
             }
 
-            r = requests.post(
+            r = self.http.post(
                 settings.DMPONLINE_AUTH_URL,
                 json=params,
                 headers=headers,
@@ -257,7 +264,7 @@ class Mappings:
             "Content-Type": "application/json",
         }
         url = f"{settings.DMPONLINE_API_V1_URL}plans/{plan_id}"
-        plan = requests.get(url, headers=self.headers, verify=self.verify).json()
+        plan = self.http.get(url, headers=self.headers, verify=self.verify).json()
         if plan["code"] == 200:
             plan = plan["items"][0]["dmp"]["project"][0]
             return plan["start"], plan["end"]
@@ -265,7 +272,7 @@ class Mappings:
 
     def get_all_plan_ids(self):
         self.base_url = settings.DMPONLINE_API_V0_URL + "statistics/plans"
-        result = requests.get(self.base_url, headers=self.headers, verify=self.verify)
+        result = self.http.get(self.base_url, headers=self.headers, verify=self.verify)
         if result.status_code == 200:
             arr = []
             for item in result.json()["plans"]:
@@ -278,13 +285,13 @@ class Mappings:
     # this gets (max) 10 plans from DMPonline v0
     def get_page(self, page):
         self.base_url = f"{settings.DMPONLINE_API_V0_URL}plans?page={page}"
-        return requests.get(
+        return self.http.get(
             self.base_url, headers=self.headers, verify=self.verify
         ).json()
 
     # gets one specific plan by id
     def set_plan(self, plan_id):
-        self.plan = requests.get(
+        self.plan = self.http.get(
             self.base_url + str(plan_id), headers=self.headers, verify=self.verify
         ).json()[0]
 
@@ -446,8 +453,8 @@ class Mappings:
 
     # for now focus is on Delft 2021 template only
     def is_mappable(self):
-        logger.info(f"Template ID {self.get_template_id()}")
-        logger.info("Mappable: " + str(self.get_template_id() in MAPPABLE_IDS))
+        logger.debug(f"Template ID {self.get_template_id()}")
+        logger.debug("Mappable: " + str(self.get_template_id() in MAPPABLE_IDS))
         return self.get_template_id() in MAPPABLE_IDS
 
     def get_id(self):
@@ -467,6 +474,10 @@ class Mappings:
         dt = datetime.strptime(self.plan["last_updated"], "%Y-%m-%d %H:%M:%S %Z")
         return dt.strftime("%Y-%m-%dT%H:%M:%S")
 
+    def get_created(self):
+        dt = datetime.strptime(self.plan["creation_date"], "%Y-%m-%d %H:%M:%S %Z")
+        return dt.strftime("%Y-%m-%dT%H:%M:%S")
+
     def is_test_plan(self):
         return self.plan["test_plan"]
 
@@ -806,6 +817,19 @@ class Mappings:
             if self.has_option_selected(section, question, "> 1 TB"):
                 return "> 1 TB"
 
+    # the selected option itself (e.g. "< 250 GB") for the statistics
+    def get_storage_amount_answer(self):
+        if self.get_template_id() == 975303870:  # section 1, question 4
+            for option in ("< 250 GB", "250 GB - 5 TB", "> 5 TB"):
+                if self.has_option_selected(1, 1, option):
+                    return option
+
+    def get_storage_amount_public_answer(self):
+        if self.get_template_id() == 975303870:  # section 5, question 30
+            for option in ("< 100 GB", "100 GB - 1 TB", "> 1 TB"):
+                if self.has_option_selected(5, 4, option):
+                    return option
+
     def get_data_types(self):
         types = []
         if self.get_template_id() == 975303870:  # section 5, question 20
@@ -1078,3 +1102,22 @@ class Mappings:
                 "WssId": 1,
             },
         }
+
+    # what insert_statistics writes, so it needs no parsing of its own
+    def get_stats_mappings(self):
+        return {
+            "dmp_id": self.get_id(),
+            "created": self.get_created(),
+            "last_updated": self.get_last_updated(),
+            "type": self.get_template_id(),
+            "template_name": self.get_template_name(),
+            "personal_data": self.has_personal_data(),
+            "human_participants": self.has_human_participants(),
+            "confidential_data": self.has_confidential_data(),
+            "storage_amount": self.get_storage_amount_answer(),
+            "storage_amount_public": self.get_storage_amount_public_answer(),
+            "data_types": self.get_data_types(),
+            "share_types": self.get_share_types(),
+            "storage_locations": sorted(self.get_storage_locations_stats()),
+            "emails": [user["email"] for user in self.plan["users"]],
+        }
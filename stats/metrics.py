@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from django.conf import settings
+
+# upper bounds in seconds, requests to DMPonline and SharePoint take seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# name: (type, help)
+METRICS = {
+    "dmps_downstream_requests_total": (
+        "counter",
+        "Requests to a downstream service (DMPonline, AVG registry, ESB, SharePoint)",
+    ),
+    "dmps_downstream_errors_total": (
+        "counter",
+        "Requests to a downstream service that failed or got a 4xx/5xx response",
+    ),
+    "dmps_downstream_request_seconds": (
+        "histogram",
+        "Latency of the requests to a downstream service",
+    ),
+    "dmps_downstream_in_flight": (
+        "gauge",
+        "Requests to a downstream service waiting for their response",
+    ),
+    "dmps_plan_stage_seconds": (
+        "histogram",
+        "Time spent per processing stage of a fetch run (per plan, per page for fetch)",
+    ),
+    # reset by every run, so not a counter
+    "dmps_fetch_run_events": (
+        "gauge",
+        "Counters of the last fetch run (inserted, updated, failed, ... lines)",
+    ),
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = {
+        key: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for key, value in labels
+    }
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped.items()) + "}"
+
+
+# process-wide counters and histograms, rendered in the Prometheus text format
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}  # (name, labels): [bucket counts, sum, count]
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] = value
+
+    # {labels: value} of a counter or gauge, e.g. {(("downstream", "esb"),): 1}
+    def values(self, name):
+        with self.lock:
+            return {
+                labels: value
+                for (key, labels), value in self.counters.items()
+                if key == name
+            }
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            buckets, total, count = self.histograms.get(
+                key, ([0] * len(LATENCY_BUCKETS), 0, 0)
+            )
+            buckets = [
+                n + (seconds <= bound) for n, bound in zip(buckets, LATENCY_BUCKETS)
+            ]
+            self.histograms[key] = (buckets, total + seconds, count + 1)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, help_text) in METRICS.items():
+                counters = [(k, v) for k, v in self.counters.items() if k[0] == name]
+                histograms = [
+                    (k, v) for k, v in self.histograms.items() if k[0] == name
+                ]
+                if not counters and not histograms:
+                    continue
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                for (_, labels), value in sorted(counters):
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                for (_, labels), (buckets, total, count) in sorted(histograms):
+                    for bound, n in zip(LATENCY_BUCKETS, buckets):
+                        bucket_labels = format_labels(labels + (("le", bound),))
+                        lines.append(f"{name}_bucket{bucket_labels} {n}")
+                    bucket_labels = format_labels(labels + (("le", "+Inf"),))
+                    lines.append(f"{name}_bucket{bucket_labels} {count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+    # replaced atomically, so the metrics view never serves half a file
+    def write(self, path=None):
+        path = path or settings.STATS_METRICS_FILE
+        with open(f"{path}.tmp", "w") as out:
+            out.write(self.render())
+        os.replace(f"{path}.tmp", path)
+
+
+metrics = Metrics()
+
+
+# requests to one downstream service, counted and timed in metrics; the
+# session keeps the connections (and NTLM handshakes) alive between requests
+class Downstream:
+    def __init__(self, name):
+        self.name = name
+        self.session = requests.Session()
+
+    def request(self, method, url, **kwargs):
+        start = time.perf_counter()
+        metrics.inc("dmps_downstream_in_flight", downstream=self.name)
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            metrics.inc("dmps_downstream_errors_total", downstream=self.name)
+            raise
+        finally:
+            metrics.inc("dmps_downstream_in_flight", -1, downstream=self.name)
+            metrics.inc(
+                "dmps_downstream_requests_total", downstream=self.name, method=method
+            )
+            metrics.observe(
+                "dmps_downstream_request_seconds",
+                time.perf_counter() - start,
+                downstream=self.name,
+            )
+        if response.status_code >= 400:
+            metrics.inc("dmps_downstream_errors_total", downstream=self.name)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
@@ -1,22 +1,23 @@
 from django.db import models
+from django.utils import timezone
 
 
 class StorageLocation(models.Model):
-    name = models.CharField(max_length=32)
+    name = models.CharField(max_length=255)
 
     def __str__(self):
         return self.name
 
 
 class DataType(models.Model):
-    name = models.CharField(max_length=64)
+    name = models.CharField(max_length=255)
 
     def __str__(self):
         return self.name
 
 
 class ShareType(models.Model):
-    name = models.CharField(max_length=64)
+    name = models.CharField(max_length=255)
 
     def __str__(self):
         return self.name
@@ -33,12 +34,24 @@ class DMP(models.Model):
     storage_locations = models.ManyToManyField(
         to=StorageLocation, blank=True, related_name="dmps"
     )
-    data_amount = models.IntegerField(blank=True, null=True)
-    data_amount_public = models.IntegerField(blank=True, null=True)
+    data_amount = models.IntegerField(blank=True, null=True)  # GB
+    data_amount_public = models.IntegerField(blank=True, null=True)  # GB
+    data_amount_bytes = models.BigIntegerField(blank=True, null=True)
+    data_amount_public_bytes = models.BigIntegerField(blank=True, null=True)
+    # "> 5 TB": the bytes are the lower bound, not the upper bound of a range
+    data_amount_open_ended = models.BooleanField(default=False)
+    data_amount_public_open_ended = models.BooleanField(default=False)
+    # log-scale bins, see helpers.get_storage_bucket()
+    data_amount_bucket = models.SmallIntegerField(blank=True, null=True, db_index=True)
+    data_amount_public_bucket = models.SmallIntegerField(
+        blank=True, null=True, db_index=True
+    )
     data_types_public = models.ManyToManyField(
         to=DataType, blank=True, related_name="dmps"
     )
     share_types = models.ManyToManyField(to=ShareType, blank=True, related_name="dmps")
+    created = models.DateTimeField(blank=True, null=True)
+    last_updated = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
         return str(self.dmp_id)
@@ -83,3 +96,136 @@ class DataUser(models.Model):
 
     def __str__(self):
         return "DMP: " + str(self.dmp) + " Email hash: " + self.email_hash
+
+
+class Researcher(models.Model):
+    # one row per person, DataUser is only kept for the rows of older runs
+    email_hash = models.CharField(max_length=32, unique=True)
+    faculty_department = models.ForeignKey(
+        to=FacultyDepartment,
+        blank=True,
+        null=True,
+        related_name="researchers",
+        on_delete=models.CASCADE,
+    )
+    dmps = models.ManyToManyField(to=DMP, blank=True, related_name="researchers")
+
+    def __str__(self):
+        return "Email hash: " + self.email_hash
+
+
+class Aggregate(models.Model):
+    # precomputed answer counts for the dashboard, rebuilt after every fetch run
+    question = models.CharField(max_length=64)
+    value = models.JSONField(blank=True, null=True)
+    total = models.IntegerField()
+
+    def __str__(self):
+        return self.question + ": " + str(self.value) + " (" + str(self.total) + ")"
+
+
+class DataVersion(models.Model):
+    # bumped by fetch when a run completes, keys the cached stats responses
+    version = models.CharField(max_length=32)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.version
+
+
+class Rollup(models.Model):
+    # DMPs created per month for every answer, rebuilt after every fetch run
+    month = models.DateField()
+    question = models.CharField(max_length=64)
+    value = models.JSONField(blank=True, null=True)
+    total = models.IntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=["question", "month"])]
+
+    def __str__(self):
+        return (
+            str(self.month)
+            + " "
+            + self.question
+            + ": "
+            + str(self.value)
+            + " ("
+            + str(self.total)
+            + ")"
+        )
+
+
+class SyncRun(models.Model):
+    # one fetch run, saved after every page so a running sync shows its progress
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+    STATUSES = [(RUNNING, "Running"), (FINISHED, "Finished"), (FAILED, "Failed")]
+
+    started = models.DateTimeField(default=timezone.now)
+    finished = models.DateTimeField(blank=True, null=True)
+    status = models.CharField(max_length=8, choices=STATUSES, default=RUNNING)
+    begin_page = models.IntegerField()
+    end_page = models.IntegerField()
+    counters = models.JSONField(default=dict)  # total_dmps, dj_avg_ins, ...
+    stage_seconds = models.JSONField(default=dict)  # fetch, map, avg, sharepoint, stats
+    plans_per_second = models.FloatField(blank=True, null=True)
+    # fetch --shard K/N: the shards are runs under one run of the whole batch,
+    # which gets their summed counters when the last shard is done
+    batch = models.CharField(max_length=64, blank=True, null=True, unique=True)
+    parent = models.ForeignKey(
+        "self",
+        blank=True,
+        null=True,
+        on_delete=models.CASCADE,
+        related_name="shards",
+    )
+    shard = models.IntegerField(blank=True, null=True)  # K
+    shard_count = models.IntegerField(blank=True, null=True)  # N
+
+    class Meta:
+        indexes = [models.Index(fields=["started"])]
+
+    def __str__(self):
+        return (
+            str(self.started)
+            + " pages "
+            + str(self.begin_page)
+            + "-"
+            + str(self.end_page)
+            + " ("
+            + self.status
+            + ")"
+        )
+
+
+class PlanLease(models.Model):
+    # the shard run processing a plan, the other shards skip the plan until
+    # the lease expires (e.g. because that run died)
+    plan_id = models.IntegerField(unique=True)
+    run = models.ForeignKey(SyncRun, on_delete=models.CASCADE, related_name="leases")
+    expires = models.DateTimeField()
+
+    def __str__(self):
+        return str(self.plan_id) + " (run " + str(self.run_id) + ")"
+
+
+class RunLease(models.Model):
+    # held by the one fetch that may run (see stats.leases), renewed by its
+    # heartbeat; a lease past its expiry belongs to a fetch that died
+    name = models.CharField(max_length=64, unique=True)
+    holder = models.CharField(max_length=128)  # host:pid:token
+    # shared by the shards of a batch: group is the batch, holders the shards
+    # still holding it
+    group = models.CharField(max_length=64, blank=True, null=True)
+    holders = models.IntegerField(default=1)
+    run = models.ForeignKey(
+        SyncRun, blank=True, null=True, on_delete=models.SET_NULL, related_name="+"
+    )
+    acquired = models.DateTimeField()
+    heartbeat = models.DateTimeField()
+    expires = models.DateTimeField()
+
+    def __str__(self):
+        return self.name + " (" + self.holder + ")"
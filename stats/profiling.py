@@ -0,0 +1,104 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger("main")
+
+SAMPLE_INTERVAL = 0.005  # seconds
+TOP_ALLOCATORS = 10
+
+
+# samples the stack of one thread at a fixed interval, the counts of the stacks
+# are written in the collapsed format of flamegraph.pl and speedscope
+class StackSampler:
+    def __init__(self, thread_id=None, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self, path):
+        with open(path, "w") as out:
+            for stack, count in self.stacks.most_common():
+                out.write(f"{stack} {count}\n")
+
+
+# runs the block under cProfile and the stack sampler, writes <prefix>.txt
+# (functions sorted by cumulative time), <prefix>.pstats and <prefix>.folded
+@contextmanager
+def profile(prefix):
+    profiler = cProfile.Profile()
+    sampler = StackSampler()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        sampler.stop()
+        profiler.dump_stats(f"{prefix}.pstats")
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats()
+        with open(f"{prefix}.txt", "w") as out:
+            out.write(report.getvalue())
+        sampler.write(f"{prefix}.folded")
+        logger.info(f"Profile written to {prefix}.txt, .pstats and .folded")
+
+
+# tracemalloc snapshots (e.g. one per page), logs the lines that allocated most
+# since the previous snapshot and the peak of the traced memory
+class MemoryTracer:
+    def __init__(self, top=TOP_ALLOCATORS):
+        self.top = top
+        self.previous = None
+        tracemalloc.start()
+
+    def snapshot(self, label):
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        if self.previous:
+            statistics = snapshot.compare_to(self.previous, "lineno")
+        else:
+            statistics = snapshot.statistics("lineno")
+        self.previous = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"Memory after {label}: {current / 2 ** 20:.1f} MiB, "
+            f"peak {peak / 2 ** 20:.1f} MiB, top allocators:",
+            *[f"  {statistic}" for statistic in statistics[: self.top]],
+        ]
+        logger.info("\n".join(lines))
+        return lines
+
+    def stop(self):
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        logger.info(f"Peak traced memory: {peak / 2 ** 20:.1f} MiB")
+        return peak
@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from stats.metrics import metrics
+
+logger = logging.getLogger("main")
+
+
+# signal handlers can only be set in the main thread, SIGUSR1 is POSIX only
+def can_handle_signals():
+    return (
+        hasattr(signal, "SIGUSR1")
+        and threading.current_thread() is threading.main_thread()
+    )
+
+
+# progress of a fetch run, logged and written to STATS_PROGRESS_FILE every
+# interval seconds, on SIGUSR1 (kill -USR1 <pid>) and when the run ends
+class Progress:
+    def __init__(self, run, pages, interval=60):
+        self.run = run
+        self.pages = pages
+        self.interval = interval
+        self.pages_done = 0
+        self.started = time.monotonic()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.report_periodically, daemon=True)
+        self.previous_handler = None
+
+    def page_done(self):
+        self.pages_done += 1
+
+    def status(self):
+        elapsed = time.monotonic() - self.started
+        plans_done = self.run.counters["total_dmps"]
+        eta = None
+        if self.pages_done:
+            eta = elapsed / self.pages_done * (self.pages - self.pages_done)
+        return {
+            "run": self.run.pk,
+            "status": self.run.status,
+            "started": self.run.started,
+            "updated": timezone.now(),
+            "pages_done": self.pages_done,
+            "pages": self.pages,
+            "plans_done": plans_done,
+            "plans_per_second": plans_done / elapsed if elapsed else 0,
+            "in_flight": {
+                dict(labels)["downstream"]: value
+                for labels, value in metrics.values("dmps_downstream_in_flight").items()
+            },
+            "eta_seconds": eta,
+        }
+
+    def report(self):
+        status = self.status()
+        eta = status["eta_seconds"]
+        logger.info(
+            f"Progress: {status['pages_done']}/{status['pages']} pages, "
+            f"{status['plans_done']} plans, {status['plans_per_second']:.2f} plans/s, "
+            f"in flight {status['in_flight']}, "
+            f"ETA {'unknown' if eta is None else f'{eta:.0f}s'}"
+        )
+        path = settings.STATS_PROGRESS_FILE
+        with open(f"{path}.tmp", "w") as out:
+            json.dump(status, out, cls=DjangoJSONEncoder)
+        os.replace(f"{path}.tmp", path)
+        return status
+
+    def report_periodically(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if not self.stopped.is_set():
+                self.report()
+
+    # the signal handler only wakes the reporting thread, instead of reporting
+    # in the middle of whatever the main thread was doing
+    def start(self):
+        if can_handle_signals():
+            self.previous_handler = signal.signal(
+                signal.SIGUSR1, lambda signum, frame: self.wakeup.set()
+            )
+        self.thread.start()
+
+    # restores the handler from before start(), the default one would
+    # terminate the process on a late kill -USR1
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.thread.join()
+        if can_handle_signals() and self.previous_handler is not None:
+            signal.signal(signal.SIGUSR1, self.previous_handler)
+        return self.report()
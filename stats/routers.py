@@ -0,0 +1,64 @@
+import asyncio
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+
+# set while a stats view runs, its queries go to the read connection
+reading = ContextVar("reading", default=False)
+
+
+# the stats views read through the STATS_READ_DATABASE connection (a second SQLite
+# connection in WAL mode, or a replica), fetch and everything else reads and writes the
+# primary, so it always sees its own writes
+class ReadRouter:
+    def db_for_read(self, model, **hints):
+        if reading.get():
+            return settings.STATS_READ_DATABASE
+        return "default"
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == "default"
+
+
+# runs a (sync or async) view with its queries routed to the read connection
+def read_database(view):
+    if asyncio.iscoroutinefunction(view):
+
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            token = reading.set(True)
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                reading.reset(token)
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        token = reading.set(True)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            reading.reset(token)
+
+    return wrapper
+
+
+# connection_created handler, WAL lets the read connection see the last committed
+# data while fetch holds a write transaction, the read connection cannot write
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        if connection.alias == "read":
+            cursor.execute("PRAGMA query_only = ON")
@@ -0,0 +1,85 @@
+import argparse
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from stats.models import PlanLease, SyncRun
+
+
+# K/N of fetch --shard, the shards are numbered 1 to N
+def parse_shard(value):
+    try:
+        shard, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("use K/N, e.g. 2/4")
+    if not 1 <= shard <= count:
+        raise argparse.ArgumentTypeError("K/N needs 1 <= K <= N")
+    return shard, count
+
+
+# every Nth page starting at the Kth page of the range, so each shard gets as
+# many old (long) plans as new ones
+def shard_pages(begin, end, shard, count):
+    return list(range(begin + shard - 1, end, count))
+
+
+# the run of the whole batch, created by whichever shard starts first
+def get_batch_run(batch, begin, end, count):
+    run, created = SyncRun.objects.get_or_create(
+        batch=batch,
+        defaults={
+            "begin_page": begin,
+            "end_page": end,
+            "shard_count": count,
+            "counters": Counter(),
+            "stage_seconds": Counter(),
+        },
+    )
+    if run.finished or run.shard_count != count:
+        raise CommandError(f"Batch {batch} is finished or has another shard count")
+    return run
+
+
+# True if the plan is ours: not leased yet, leased by this run before or the
+# lease of another run expired
+def lease_plan(run, plan_id):
+    now = timezone.now()
+    expires = now + timedelta(seconds=settings.PLAN_LEASE_SECONDS)
+    try:
+        with transaction.atomic():
+            PlanLease.objects.create(plan_id=plan_id, run=run, expires=expires)
+        return True
+    except IntegrityError:
+        return bool(
+            PlanLease.objects.filter(
+                Q(run=run) | Q(expires__lt=now), plan_id=plan_id
+            ).update(run=run, expires=expires)
+        )
+
+
+# called by every shard when it's done, returns the batch run with the summed
+# counters of its shards for the last one and None for the others
+def merge_shards(run):
+    batch = SyncRun.objects.get(pk=run.parent_id)
+    shards = list(batch.shards.all())
+    if len(shards) < batch.shard_count or any(
+        shard.status == SyncRun.RUNNING for shard in shards
+    ):
+        return None
+    # shards finishing at the same time both get here, only one claims it
+    if not SyncRun.objects.filter(pk=batch.pk, finished=None).update(
+        finished=timezone.now()
+    ):
+        return None
+    batch.counters = Counter()
+    batch.stage_seconds = Counter()
+    for shard in shards:
+        batch.counters.update(shard.counters)
+        batch.stage_seconds.update(shard.stage_seconds)
+    PlanLease.objects.filter(run__parent=batch).delete()
+    return batch
@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from stats.aggregates import AGGREGATES, sort_key
+from stats.models import DMP
+
+logger = logging.getLogger("main")
+
+NUMERIC_COLUMNS = (
+    "dmp_id",
+    "data_amount",
+    "data_amount_public",
+    "data_amount_bytes",
+    "data_amount_public_bytes",
+)
+
+
+# columnar copy of the anonymised statistics, one row per DMP
+# every AGGREGATES question is dictionary-encoded: "<question>.codes" index into
+# dictionaries[question] and "<question>.offsets" delimit the codes of each row
+# (multi-valued questions have several codes per row, DMPs without a value get None)
+class Snapshot:
+    def __init__(self, version, size, dictionaries, columns, created=None):
+        self.version = version
+        self.size = size
+        self.dictionaries = dictionaries
+        self.columns = columns
+        self.created = created or timezone.now().isoformat()
+
+    @classmethod
+    def from_database(cls, version):
+        rows = list(DMP.objects.order_by("pk").values_list("pk", *NUMERIC_COLUMNS))
+        positions = {row[0]: i for i, row in enumerate(rows)}
+        size = len(rows)
+        columns = {
+            name: np.array(
+                [np.nan if row[i + 1] is None else row[i + 1] for row in rows],
+                dtype=np.int64 if name == "dmp_id" else np.float64,
+            )
+            for i, name in enumerate(NUMERIC_COLUMNS)
+        }
+        dictionaries = {}
+        for question in AGGREGATES:
+            members = list(
+                DMP.objects.order_by("pk").values_list("pk", question[0]).distinct()
+            )
+            dictionary = sorted({value for pk, value in members}, key=sort_key)
+            codes = {value: code for code, value in enumerate(dictionary)}
+            lengths = np.bincount(
+                np.array([positions[pk] for pk, value in members], dtype=np.int64),
+                minlength=size,
+            )
+            dictionaries[question[0]] = dictionary
+            columns[question[0] + ".codes"] = np.array(
+                [codes[value] for pk, value in members], dtype=np.int32
+            )
+            columns[question[0] + ".offsets"] = np.concatenate(
+                ([0], np.cumsum(lengths))
+            ).astype(np.int64)
+        return cls(version, size, dictionaries, columns)
+
+    # row position of every code in a question's codes column
+    def rows(self, question):
+        offsets = self.columns[question + ".offsets"]
+        return np.repeat(np.arange(self.size), np.diff(offsets))
+
+    # writes a new version directory next to the old ones, then
+    # atomically points CURRENT at it
+    def write(self, directory):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        tmp = directory / f".tmp-{self.version}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir()
+        for name, column in self.columns.items():
+            np.save(tmp / f"{name}.npy", column)
+        with open(tmp / "meta.json", "w") as out:
+            json.dump(
+                {
+                    "version": self.version,
+                    "size": self.size,
+                    "created": self.created,
+                    "dictionaries": self.dictionaries,
+                },
+                out,
+            )
+        os.replace(tmp, directory / self.version)
+        with open(directory / "CURRENT.tmp", "w") as out:
+            out.write(self.version)
+        os.replace(directory / "CURRENT.tmp", directory / "CURRENT")
+
+        # keep the previous version around for workers that are still reading it
+        previous = sorted(
+            (path for path in directory.iterdir() if path.is_dir()),
+            key=lambda path: path.stat().st_mtime,
+        )[:-2]
+        for path in previous:
+            shutil.rmtree(path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path)
+        with open(path / "meta.json") as f:
+            meta = json.load(f)
+        columns = {
+            file.name[: -len(".npy")]: np.load(file, mmap_mode="r")
+            for file in path.glob("*.npy")
+        }
+        return cls(
+            meta["version"],
+            meta["size"],
+            meta["dictionaries"],
+            columns,
+            meta["created"],
+        )
+
+
+def write_snapshot(version):
+    snapshot = Snapshot.from_database(version)
+    snapshot.write(settings.STATS_SNAPSHOT_DIR)
+    logger.info(f"Wrote snapshot {version} with {snapshot.size} DMPs")
+    return snapshot
+
+
+def read_snapshot_version():
+    try:
+        with open(Path(settings.STATS_SNAPSHOT_DIR) / "CURRENT") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+_snapshot_lock = threading.Lock()
+_snapshot = None
+
+
+# memory-maps the current snapshot, workers share it through the page cache
+# returns None before fetch has written the first snapshot
+def load_snapshot():
+    global _snapshot
+    version = read_snapshot_version()
+    if version is None:
+        return None
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.version != version:
+            _snapshot = Snapshot.load(Path(settings.STATS_SNAPSHOT_DIR) / version)
+        return _snapshot
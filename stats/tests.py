@@ -1,12 +1,92 @@
+import argparse
+import io
 import json
+import logging
+import os
+import re
+import signal
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
+import numpy as np
+import pytest
 import requests
 from django.conf import settings
+from django.http import QueryDict
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import OperationalError
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.urls import reverse
 
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+
+from stats.aggregates import (
+    AGGREGATES,
+    compute_aggregate,
+    compute_aggregates,
+    compute_aggregates_async,
+    get_aggregates,
+    rebuild_aggregates,
+    rebuild_rollups,
+)
+from stats.cache import bump_data_version, normalise_query
+from stats.facets import FacetIndex, get_facet_index
+from stats.helpers import get_storage_bucket, is_open_ended, parse_storage_amount
+from dmps.asgi import application
+from stats import leases, views
+from stats.leases import Lease
+from stats.log import JsonFormatter, queue_loggers
+from stats.management.commands.fetch import (
+    finish_batch,
+    finish_run,
+    process_plan,
+    set_storage_amounts,
+    timed_stage,
+)
+from stats.management.commands import sync_daemon
+from stats.mapping_pool import map_plan, mapping_pool
 from stats.mappings import Mappings, SharePointConn, ESBConnection, AvgRegistry
+from stats.metrics import metrics
+from stats.models import (
+    DMP,
+    Aggregate,
+    DataType,
+    DataUser,
+    FacultyDepartment,
+    PlanLease,
+    Researcher,
+    RunLease,
+    StorageLocation,
+    SyncRun,
+)
+from stats.profiling import MemoryTracer, profile
+from stats.progress import Progress
+from stats.routers import ReadRouter, reading
+from stats.sharding import (
+    get_batch_run,
+    lease_plan,
+    parse_shard,
+    shard_pages,
+)
+from stats.snapshot import Snapshot, load_snapshot, write_snapshot
 import responses
 
 
+@pytest.fixture(autouse=True)
+def snapshot_dir(settings, tmp_path):
+    settings.STATS_SNAPSHOT_DIR = str(tmp_path / "snapshot")
+
+
+# the rows of the test transaction are only visible on the default connection
+@pytest.fixture(autouse=True)
+def read_database(settings):
+    settings.STATS_READ_DATABASE = "default"
+
+
 def test_plan_mappings(request):
     # instantiate Mappings but do not make
     # contact with any 'real' servers (do_init=False)
@@ -43,6 +123,7 @@ def test_plan_mappings(request):
     assert mapping.has_special_categories() is None
     assert type(mapping.get_storage_locations_stats()) == set
     assert mapping.get_last_updated() == "2021-09-16T12:37:56"
+    assert mapping.get_created() == "2021-09-02T08:31:44"
     assert not mapping.is_test_plan()
     assert mapping.is_mappable()
     assert not mapping.has_personal_data()
@@ -288,3 +369,936 @@ def test_django_avg_line(request):
     assert AvgRegistry().get_all().status_code == 200
     e, a = AvgRegistry().remove_record(1, 1)
     assert e.status_code, a.status_code == (200, 200)
+
+
+@pytest.mark.django_db
+def test_rebuild_aggregates(client):
+    dmp = DMP.objects.create(dmp_id=1, type=975303870, template_name="TU Delft")
+    DMP.objects.create(dmp_id=2, type=975303870, template_name="TU Delft")
+    dmp.storage_locations.add(StorageLocation.objects.create(name="Project Drive"))
+
+    rebuild_aggregates()
+    bump_data_version()
+    assert Aggregate.objects.get(question="template_name").total == 2
+
+    types = client.get(reverse("stats")).json()["types"]
+    assert types[0] == [["Template kind", "total"], ["TU Delft", 2]]
+    assert ["Project Drive", 1] in types[5]
+    assert ["Unknown", 1] in types[5]
+
+    response = client.get(reverse("index"))
+    assert response.status_code == 200
+    assert "Project Drive" in response.content.decode()
+
+
+@pytest.mark.django_db
+def test_stats_cache(client, django_assert_num_queries):
+    assert normalise_query(QueryDict("b[]=2&a[]=3&a[]=1")) == "a[]=1&a[]=3&b[]=2"
+
+    DMP.objects.create(dmp_id=1, type=975303870, template_name="TU Delft")
+    bump_data_version()
+    first = client.get(reverse("stats")).json()
+    DMP.objects.create(dmp_id=2, type=975303870, template_name="TU Delft")
+    with django_assert_num_queries(1):  # only the data version lookup
+        assert client.get(reverse("stats")).json() == first
+
+    bump_data_version()
+    assert client.get(reverse("stats")).json()["types"][0][1] == ["TU Delft", 2]
+
+
+@pytest.mark.django_db
+def test_facet_index(client):
+    drive = StorageLocation.objects.create(name="Project Drive")
+    surf = StorageLocation.objects.create(name="SURFdrive")
+    for dmp_id, personal_data, locations in (
+        (1, True, [drive, surf]),
+        (2, True, [surf]),
+        (3, False, [drive]),
+        (4, None, []),
+    ):
+        dmp = DMP.objects.create(dmp_id=dmp_id, type=1, personal_data=personal_data)
+        dmp.storage_locations.add(*locations)
+
+    index = FacetIndex.from_snapshot(Snapshot.from_database("1"))
+    counts = index.counts()
+    assert counts["personal_data"] == [(None, 1), (False, 1), (True, 2)]
+    assert counts["storage_locations__name"] == [
+        (None, 1),
+        ("Project Drive", 2),
+        ("SURFdrive", 2),
+    ]
+
+    mask = index.mask({"personal_data": ["True", "None"]})
+    assert index.counts(mask)["storage_locations__name"] == [
+        (None, 1),
+        ("Project Drive", 1),
+        ("SURFdrive", 2),
+    ]
+    mask = index.mask(
+        {"personal_data": ["True"], "storage_locations__name": ["Project Drive"]}
+    )
+    assert index.counts(mask)["personal_data"] == [(True, 1)]
+
+    bump_data_version()
+    response = client.get(reverse("filter") + "?personal_data[]=False")
+    assert json.loads(response.context["filtered_data"])[5] == [
+        ["Used storage location", "total"],
+        ["Project Drive", 1],
+    ]
+
+
+@pytest.mark.django_db
+def test_snapshot(client, django_assert_num_queries):
+    assert load_snapshot() is None
+    dmp = DMP.objects.create(dmp_id=1, type=1, data_amount=250, personal_data=True)
+    dmp.storage_locations.add(
+        StorageLocation.objects.create(name="Project Drive"),
+        StorageLocation.objects.create(name="SURFdrive"),
+    )
+    DMP.objects.create(dmp_id=2, type=1)
+
+    write_snapshot(bump_data_version())
+    snapshot = load_snapshot()
+    assert snapshot.size == 2
+    assert list(snapshot.columns["dmp_id"]) == [1, 2]
+    assert snapshot.columns["data_amount"][0] == 250
+    assert snapshot.dictionaries["storage_locations__name"] == [
+        None,
+        "Project Drive",
+        "SURFdrive",
+    ]
+    assert list(snapshot.columns["storage_locations__name.offsets"]) == [0, 2, 3]
+    assert type(snapshot.columns["personal_data.codes"]) == np.memmap
+
+    with django_assert_num_queries(0):
+        types = client.get(reverse("stats")).json()["types"]
+        assert get_facet_index().counts()["personal_data"] == [(None, 1), (True, 1)]
+    assert ["SURFdrive", 1] in types[5]
+
+    # a new version replaces the mapped one
+    DMP.objects.create(dmp_id=3, type=1)
+    write_snapshot(bump_data_version())
+    assert load_snapshot().size == 3
+    # the index of a snapshot taken before the new version matches its rows
+    assert get_facet_index(snapshot).size == 2
+    assert get_facet_index().size == 3
+
+
+@pytest.mark.django_db
+def test_crosstab(client):
+    drive = StorageLocation.objects.create(name="Project Drive")
+    surf = StorageLocation.objects.create(name="SURFdrive")
+    for dmp_id, personal_data, locations in (
+        (1, True, [drive, surf]),
+        (2, True, [surf]),
+        (3, False, [drive]),
+    ):
+        dmp = DMP.objects.create(dmp_id=dmp_id, type=1, personal_data=personal_data)
+        dmp.storage_locations.add(*locations)
+    bump_data_version()
+
+    url = reverse("crosstab") + "?row=storage_locations__name&col=personal_data"
+    assert client.get(url).json()["types"] == [
+        ["Used storage location / Work with personal data", "No", "Yes"],
+        ["Project Drive", 1, 1],
+        ["SURFdrive", 0, 2],
+    ]
+    assert client.get(url + "&personal_data[]=True").json()["types"] == [
+        ["Used storage location / Work with personal data", "Yes"],
+        ["Project Drive", 1],
+        ["SURFdrive", 2],
+    ]
+    assert client.get(reverse("crosstab") + "?row=dmp_id&col=type").status_code == 400
+
+
+@pytest.mark.django_db
+def test_distinct_counts(client):
+    tnw = FacultyDepartment.objects.create(name="TNW-BT")
+    ewi = FacultyDepartment.objects.create(name="EWI-ST")
+    dmp = DMP.objects.create(dmp_id=1, type=1)
+    dmp.storage_locations.add(StorageLocation.objects.create(name="Project Drive"))
+    for email_hash, faculty_department in (
+        ("a", tnw),
+        ("b", tnw),
+        ("c", tnw),
+        ("d", ewi),
+    ):
+        Researcher.objects.create(
+            email_hash=email_hash, faculty_department=faculty_department
+        ).dmps.add(dmp)
+    DMP.objects.create(dmp_id=2, type=1)
+
+    rebuild_aggregates()
+    bump_data_version()
+    expected = [(None, 1), ("EWI-ST", 1), ("TNW-BT", 1)]
+    assert get_aggregates()["researchers__faculty_department__name"] == expected
+    assert (
+        get_facet_index().counts()["researchers__faculty_department__name"] == expected
+    )
+    assert get_aggregates()["storage_locations__name"] == [
+        (None, 1),
+        ("Project Drive", 1),
+    ]
+
+
+@pytest.mark.django_db
+def test_export(client, tmp_path, monkeypatch, settings):
+    tnw = FacultyDepartment.objects.create(name="TNW-BT")
+    drive = StorageLocation.objects.create(name="Project Drive")
+    surf = StorageLocation.objects.create(name="SURFdrive")
+    dmp = DMP.objects.create(dmp_id=1, type=1, personal_data=True, data_amount=250)
+    dmp.storage_locations.add(drive, surf)
+    Researcher.objects.create(email_hash="a", faculty_department=tnw).dmps.add(dmp)
+    Researcher.objects.create(email_hash="b", faculty_department=tnw).dmps.add(dmp)
+    DMP.objects.create(dmp_id=2, type=1, personal_data=False)
+
+    response = client.get(reverse("export_csv"))
+    lines = b"".join(response.streaming_content).decode().splitlines()
+    assert lines[0].startswith("dmp_id,type,template_name")
+    assert lines[1] == (
+        "1,1,,,True,,250,,,,False,False,,,Project Drive; SURFdrive,,,TNW-BT"
+    )
+    assert len(lines) == 3
+
+    response = client.get(
+        reverse("export_ndjson")
+        + "?personal_data[]=True&storage_locations__name[]=SURFdrive"
+    )
+    rows = [
+        json.loads(line) for line in b"".join(response.streaming_content).splitlines()
+    ]
+    assert [row["dmp_id"] for row in rows] == [1]
+    assert rows[0]["faculty_departments"] == ["TNW-BT"]
+
+    call_command(
+        "export",
+        format="ndjson",
+        output=str(tmp_path / "out"),
+        filter=["personal_data=None"],
+    )
+    assert (tmp_path / "out").read_text() == ""
+
+    # the rows are streamed after the view returned, still from the read database
+    # (the snapshot answers the conditional request without a query)
+    write_snapshot(bump_data_version())
+    settings.STATS_READ_DATABASE = "read"
+    databases = []
+
+    def export_rows(queryset):
+        databases.append(queryset.db)
+        yield from ()
+
+    monkeypatch.setattr(views, "export_rows", export_rows)
+    b"".join(client.get(reverse("export_csv")).streaming_content)
+    assert databases == ["read"]
+
+
+# through the ASGI handler, which (in Django 3.2) iterates a streaming response
+# on the event loop, the test client doesn't
+@pytest.mark.django_db(transaction=True)
+def test_asgi_export():
+    DMP.objects.create(dmp_id=1, type=1, personal_data=True)
+    DMP.objects.create(dmp_id=2, type=1, personal_data=False)
+
+    async def get(path, query_string):
+        communicator = ApplicationCommunicator(
+            application,
+            {
+                "type": "http",
+                "method": "GET",
+                "path": path,
+                "query_string": query_string,
+                "headers": [],
+            },
+        )
+        await communicator.send_input({"type": "http.request"})
+        start = await communicator.receive_output(5)
+        body = b""
+        message = {"more_body": True}
+        while message.get("more_body"):
+            message = await communicator.receive_output(5)
+            body += message.get("body", b"")
+        return start["status"], body
+
+    status, body = async_to_sync(get)(reverse("export_csv"), b"")
+    assert status == 200
+    assert len(body.decode().splitlines()) == 3
+    status, body = async_to_sync(get)(reverse("export_ndjson"), b"personal_data[]=True")
+    assert [json.loads(line)["dmp_id"] for line in body.splitlines()] == [1]
+
+
+@pytest.mark.django_db
+def test_timeseries(client):
+    for dmp_id, created, personal_data in (
+        (1, datetime(2021, 7, 12, 10, tzinfo=timezone.utc), True),
+        (2, datetime(2021, 7, 30, 10, tzinfo=timezone.utc), False),
+        (3, datetime(2021, 9, 2, 10, tzinfo=timezone.utc), True),
+        (4, None, True),
+    ):
+        DMP.objects.create(
+            dmp_id=dmp_id, type=1, created=created, personal_data=personal_data
+        )
+    rebuild_rollups()
+    bump_data_version()
+
+    response = client.get(reverse("timeseries") + "?question=personal_data")
+    assert response.json() == {
+        "title": "Work with personal data",
+        "types": [["Month", "No", "Yes"], ["2021-07", 1, 1], ["2021-09", 0, 1]],
+    }
+    assert client.get(reverse("timeseries")).status_code == 400
+
+
+def test_parse_storage_amount():
+    assert parse_storage_amount("< 250 GB") == 250 * 10**9
+    assert parse_storage_amount("250 GB - 5 TB") == 5 * 10**12
+    assert parse_storage_amount("> 5 TB") == 5 * 10**12
+    assert parse_storage_amount("100 GB - 1 TB") == 10**12
+    assert parse_storage_amount("1.5 tb") == 1500 * 10**9
+    assert parse_storage_amount("I don't know") is None
+    assert parse_storage_amount(None) is None
+    assert is_open_ended("> 5 TB") and not is_open_ended("250 GB - 5 TB")
+    assert not is_open_ended(None)
+    assert get_storage_bucket(10**12) == 39
+    assert get_storage_bucket(None) is None
+
+    mapping = Mappings(token=None, base_url=None, do_init=False)
+    with open("test_files/out.json") as f:
+        mapping.set_plan_by_dict(json.load(f))
+    assert mapping.get_storage_amount_answer() == "< 250 GB"
+    dmp = DMP()
+    set_storage_amounts(
+        dmp,
+        mapping.get_storage_amount_answer(),
+        mapping.get_storage_amount_public_answer(),
+    )
+    assert dmp.data_amount_bytes == 250 * 10**9
+    assert dmp.data_amount_bucket == 37
+    assert dmp.data_amount == 250
+    assert dmp.data_amount_public_bytes == 100 * 10**9
+    assert not dmp.data_amount_open_ended
+
+    set_storage_amounts(dmp, "> 5 TB", "100 GB - 1 TB")
+    assert dmp.data_amount_bytes == 5 * 10**12 and dmp.data_amount_open_ended
+    assert dmp.data_amount_public_bytes == 10**12
+    assert not dmp.data_amount_public_open_ended
+
+
+@pytest.mark.django_db
+def test_storage_distribution(client):
+    for dmp_id, answer in enumerate(
+        ("< 250 GB", "< 250 GB", "250 GB - 5 TB", "> 5 TB", None)
+    ):
+        dmp = DMP(dmp_id=dmp_id, type=1)
+        set_storage_amounts(dmp, answer, None)
+        dmp.save()
+    bump_data_version()
+
+    data_amount = client.get(reverse("storage")).json()["data_amount"]
+    assert data_amount == {
+        "count": 4,
+        "total_bytes": 10500 * 10**9,
+        "histogram": [
+            [2**37, 2, 500 * 10**9, False],
+            [2**42, 1, 5 * 10**12, False],
+            [2**42, 1, 5 * 10**12, True],
+        ],
+        "percentiles": {"50": 2**37, "90": 2**42, "99": 2**42},
+    }
+
+
+@pytest.mark.django_db
+def test_capacity(client):
+    tnw = FacultyDepartment.objects.create(name="TNW-BT")
+    ewi = FacultyDepartment.objects.create(name="EWI-ST")
+    for dmp_id, amount, faculty_departments in (
+        (1, 250 * 10**9, [tnw]),
+        (2, 5 * 10**12, [tnw, ewi]),
+        (3, None, [ewi]),
+    ):
+        dmp = DMP.objects.create(
+            dmp_id=dmp_id, type=1, personal_data=True, data_amount_bytes=amount
+        )
+        for faculty_department in faculty_departments:
+            Researcher.objects.create(
+                email_hash=f"{dmp_id}{faculty_department}",
+                faculty_department=faculty_department,
+            ).dmps.add(dmp)
+    DMP.objects.create(dmp_id=4, type=1, data_amount_bytes=10**12)
+    write_snapshot(bump_data_version())
+
+    data_amount = client.get(reverse("capacity")).json()["data_amount"]
+    assert data_amount["count"] == 3
+    assert data_amount["total_bytes"] == 6250 * 10**9
+    assert data_amount["percentiles"]["50"] == 10**12
+    assert data_amount["by_faculty_department"] == [
+        ["Unknown", 10**12, 1],
+        ["EWI-ST", 5 * 10**12, 1],
+        ["TNW-BT", 5250 * 10**9, 2],
+    ]
+
+    response = client.get(reverse("capacity") + "?personal_data[]=True")
+    assert response.json()["data_amount"]["total_bytes"] == 5250 * 10**9
+    assert response.json()["data_amount_public"]["count"] == 0
+
+
+@pytest.mark.django_db
+def test_researchers(client):
+    tnw = FacultyDepartment.objects.create(name="TNW-BT")
+    first = DMP.objects.create(dmp_id=1, type=1)
+    second = DMP.objects.create(dmp_id=2, type=1)
+    for dmp in (first, second):
+        DataUser.objects.create(dmp=dmp, email_hash="a", faculty_department=tnw)
+        DataUser.objects.create(dmp=dmp, email_hash="b", faculty_department=tnw)
+    DataUser.objects.create(dmp=second, email_hash="c")
+
+    call_command("migrate_researchers")
+    assert Researcher.objects.count() == 3
+    assert Researcher.objects.get(email_hash="a").dmps.count() == 2
+    assert second.researchers.count() == 3
+
+    bump_data_version()
+    assert client.get(reverse("researchers")).json()["types"] == [
+        [["Faculty-Department", "researchers"], ["Unknown", 1], ["TNW-BT", 2]]
+    ]
+
+    # researchers without a DMP left are not counted
+    second.delete()
+    first.researchers.remove(Researcher.objects.get(email_hash="b"))
+    bump_data_version()
+    assert client.get(reverse("researchers")).json()["types"] == [
+        [["Faculty-Department", "researchers"], ["TNW-BT", 1]]
+    ]
+
+
+@pytest.mark.django_db
+def test_conditional_get(client):
+    for dmp_id in range(20):
+        DMP.objects.create(dmp_id=dmp_id, type=1, template_name=f"Template {dmp_id}")
+    write_snapshot(bump_data_version())
+
+    response = client.get(reverse("stats"))
+    etag = response["ETag"]
+    assert etag == f'"{load_snapshot().version}"'
+    assert response.has_header("Last-Modified")
+
+    response = client.get(reverse("stats"), HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response.content == b""
+    response = client.get(
+        reverse("stats"), HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]
+    )
+    assert response.status_code == 304
+
+    response = client.get(reverse("stats"), HTTP_ACCEPT_ENCODING="gzip")
+    assert response["Content-Encoding"] == "gzip"
+    assert response["ETag"] == "W/" + etag
+    # pages with a CSRF token are not compressed
+    response = client.get("/admin/login/", HTTP_ACCEPT_ENCODING="gzip")
+    assert response.status_code == 200 and not response.has_header("Content-Encoding")
+
+    write_snapshot(bump_data_version())
+    assert client.get(reverse("stats"), HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+
+# committed rows, the concurrent queries run on connections of their own
+@pytest.mark.django_db(transaction=True)
+def test_async_stats(client):
+    drive = StorageLocation.objects.create(name="Project Drive")
+    for dmp_id in (1, 2, 3):
+        dmp = DMP.objects.create(dmp_id=dmp_id, type=1, template_name="TU Delft")
+        if dmp_id > 1:
+            dmp.storage_locations.add(drive)
+    bump_data_version()
+
+    aggregates = async_to_sync(compute_aggregates_async)()
+    assert aggregates == compute_aggregates()
+    assert aggregates["storage_locations__name"] == [(None, 1), ("Project Drive", 2)]
+
+    types = client.get(reverse("stats")).json()["types"]
+    assert types[0] == [["Template kind", "total"], ["TU Delft", 3]]
+    response = client.get(
+        reverse("filter") + "?storage_locations__name[]=Project Drive"
+    )
+    assert json.loads(response.context["filtered_data"])[0][1] == ["TU Delft", 2]
+    assert client.get(reverse("index")).status_code == 200
+
+
+@pytest.mark.django_db
+def test_facet_query(client, django_assert_num_queries):
+    drive = StorageLocation.objects.create(name="Project Drive")
+    for dmp_id, personal_data, data_amount in (
+        (1, True, 250),
+        (2, None, 5),
+        (3, True, None),
+    ):
+        dmp = DMP.objects.create(
+            dmp_id=dmp_id, type=1, personal_data=personal_data, data_amount=data_amount
+        )
+        dmp.storage_locations.add(drive)
+    # several answers on several multi-valued questions of one DMP
+    dmp.storage_locations.add(StorageLocation.objects.create(name="Surfdrive"))
+    dmp.data_types_public.add(
+        DataType.objects.create(name="Text"), DataType.objects.create(name="Images")
+    )
+
+    with django_assert_num_queries(1):
+        aggregates = compute_aggregates()
+    assert aggregates == {
+        question[0]: compute_aggregate(question[0]) for question in AGGREGATES
+    }
+    assert aggregates["personal_data"] == [(None, 1), (True, 2)]
+    assert aggregates["data_amount"] == [(None, 1), (5, 1), (250, 1)]
+    assert aggregates["storage_locations__name"] == [
+        ("Project Drive", 3),
+        ("Surfdrive", 1),
+    ]
+    assert aggregates["data_types_public__name"] == [
+        (None, 2),
+        ("Images", 1),
+        ("Text", 1),
+    ]
+
+    types = client.get(reverse("facets")).json()["types"]
+    assert types[3] == [
+        ["Work with personal data", "total"],
+        ["Unknown", 1],
+        ["Yes", 2],
+    ]
+    assert types[5] == [
+        ["Used storage location", "total"],
+        ["Project Drive", 3],
+        ["Surfdrive", 1],
+    ]
+
+
+@pytest.mark.django_db
+def test_read_database(settings, tmp_path):
+    settings.STATS_READ_DATABASE = "read"
+    assert ReadRouter().db_for_read(DMP) == "default"
+    token = reading.set(True)
+    assert ReadRouter().db_for_read(DMP) == "read"
+    assert ReadRouter().db_for_write(DMP) == "default"
+    reading.reset(token)
+
+    # a file database, WAL does not apply to the in-memory test database
+    settings.SQLITE_PRAGMAS = {**settings.SQLITE_PRAGMAS, "busy_timeout": 100}
+    database = {**settings.DATABASES["default"], "NAME": str(tmp_path / "db.sqlite3")}
+    writer = DatabaseWrapper(database, "default")
+    with writer.cursor() as cursor:
+        cursor.execute("CREATE TABLE plan (id integer)")
+        cursor.execute("INSERT INTO plan VALUES (1)")
+        assert cursor.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+        # a long write transaction, like a fetch run holding its lock
+        cursor.execute("BEGIN EXCLUSIVE")
+        cursor.execute("INSERT INTO plan VALUES (2)")
+
+        def read(_):
+            reader = DatabaseWrapper(database, "read")
+            try:
+                with reader.cursor() as read_cursor:
+                    start = time.monotonic()
+                    count = read_cursor.execute("SELECT COUNT(*) FROM plan").fetchone()
+                    with pytest.raises(OperationalError):  # query_only
+                        read_cursor.execute("INSERT INTO plan VALUES (3)")
+                    return count[0], time.monotonic() - start
+            finally:
+                reader.close()
+
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(read, range(8)))
+        # the last committed data, without waiting for the writer
+        assert all(count == 1 and seconds < 0.1 for count, seconds in results)
+
+        cursor.execute("COMMIT")
+    writer.close()
+    assert read(None)[0] == 2
+
+
+@responses.activate
+def test_metrics(client, settings, tmp_path):
+    metrics.reset()
+    responses.add(responses.GET, settings.AVG_REGISTRY_URL + "externals/", json=[])
+    responses.add(
+        responses.DELETE, settings.AVG_REGISTRY_URL + "externals/1/", status=500
+    )
+    responses.add(
+        responses.DELETE,
+        settings.AVG_REGISTRY_URL + "avgregisterline/2/",
+        body=requests.ConnectionError(),
+    )
+    AvgRegistry().get_all()
+    with pytest.raises(requests.ConnectionError):
+        AvgRegistry().remove_record(1, 2)
+    with metrics.timer("dmps_plan_stage_seconds", stage="map"):
+        pass
+    metrics.set("dmps_fetch_run_events", 3, event="stats_ins")
+
+    text = metrics.render()
+    assert "# TYPE dmps_downstream_request_seconds histogram" in text
+    assert (
+        'dmps_downstream_requests_total{downstream="avg_registry",method="DELETE"} 2'
+        in text
+    )
+    assert 'dmps_downstream_errors_total{downstream="avg_registry"} 2' in text
+    assert 'dmps_downstream_request_seconds_count{downstream="avg_registry"} 3' in text
+    assert 'dmps_plan_stage_seconds_bucket{stage="map",le="+Inf"} 1' in text
+    assert "# TYPE dmps_fetch_run_events gauge" in text
+    assert 'dmps_fetch_run_events{event="stats_ins"} 3' in text
+
+    settings.STATS_METRICS_FILE = str(tmp_path / "metrics.prom")
+    assert client.get(reverse("metrics")).content == b""
+    metrics.write()
+    response = client.get(reverse("metrics"))
+    assert response["Content-Type"].startswith("text/plain")
+    assert response.content.decode() == text
+
+
+@pytest.mark.django_db
+def test_sync_runs(client, settings, tmp_path):
+    settings.STATS_METRICS_FILE = str(tmp_path / "metrics.prom")
+    run = SyncRun.objects.create(
+        begin_page=1, end_page=3, counters=Counter(), stage_seconds=Counter()
+    )
+    assert client.get(reverse("runs")).json()["runs"][0]["status"] == "running"
+
+    for stage in ("fetch", "map", "map"):
+        with timed_stage(run, stage):
+            time.sleep(0.01)
+    run.counters["total_dmps"] += 10
+    run.started -= timedelta(seconds=5)
+    finish_run(run, SyncRun.FINISHED)
+
+    run.refresh_from_db()
+    assert run.counters == {"total_dmps": 10}
+    assert run.stage_seconds["map"] >= 0.02
+    assert run.plans_per_second == pytest.approx(2, rel=0.1)
+
+    runs = client.get(reverse("runs") + "?limit=1").json()["runs"]
+    assert len(runs) == 1
+    assert runs[0]["status"] == "finished"
+    assert runs[0]["begin_page"] == 1
+    assert set(runs[0]["stage_seconds"]) == {"fetch", "map"}
+    assert client.get(reverse("runs") + "?limit=all").status_code == 400
+
+
+def test_profiling(tmp_path):
+    def slow_page():
+        time.sleep(0.2)
+        return [bytearray(1024) for i in range(1000)]
+
+    with profile(tmp_path / "fetch"):
+        slow_page()
+    assert "slow_page" in (tmp_path / "fetch.txt").read_text()
+    assert (tmp_path / "fetch.pstats").exists()
+    stack, count = (
+        (tmp_path / "fetch.folded").read_text().splitlines()[0].rsplit(" ", 1)
+    )
+    assert stack.endswith("tests.py:slow_page") and int(count) > 1
+
+    tracer = MemoryTracer()
+    tracer.snapshot("page 1")
+    pages = slow_page()
+    lines = tracer.snapshot("page 2")
+    assert "tests.py" in lines[1]  # the bytearrays of slow_page
+    assert tracer.stop() > 1000 * 1024
+    assert len(pages) == 1000
+
+
+@pytest.mark.django_db
+def test_progress(client, settings, tmp_path):
+    settings.STATS_PROGRESS_FILE = str(tmp_path / "progress.json")
+    assert client.get(reverse("progress")).status_code == 404
+
+    metrics.reset()
+    run = SyncRun.objects.create(begin_page=1, end_page=5, counters=Counter())
+    progress = Progress(run, 4, interval=3600)
+    previous = signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    progress.start()
+    progress.page_done()
+    run.counters["total_dmps"] += 10
+    metrics.inc("dmps_downstream_in_flight", downstream="esb")
+
+    os.kill(os.getpid(), signal.SIGUSR1)
+    for i in range(100):
+        if os.path.exists(settings.STATS_PROGRESS_FILE):
+            break
+        time.sleep(0.01)
+    status = client.get(reverse("progress")).json()
+    assert status["pages_done"] == 1 and status["pages"] == 4
+    assert status["plans_done"] == 10
+    assert status["in_flight"] == {"esb": 1}
+    assert status["eta_seconds"] >= 0
+
+    progress.page_done()
+    run.status = SyncRun.FINISHED
+    status = progress.stop()
+    assert status["pages_done"] == 2
+    # a late kill -USR1 doesn't terminate the process
+    assert signal.getsignal(signal.SIGUSR1) is signal.SIG_IGN
+    signal.signal(signal.SIGUSR1, previous)
+    assert client.get(reverse("progress")).json()["status"] == "finished"
+
+
+def test_queued_logging():
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter())
+    logger = logging.getLogger("test_queued_logging")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    listener = queue_loggers([logger.name])
+    assert logger.handlers != [handler]
+
+    logger.debug("left out")
+    logger.info("Run %s", "finished", extra={"counters": {"total_dmps": 3}})
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        logger.exception("failed")
+    listener.stop()
+
+    first, second = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert first["message"] == "Run finished"
+    assert first["level"] == "INFO" and first["logger"] == "test_queued_logging"
+    assert first["counters"] == {"total_dmps": 3}
+    assert "ZeroDivisionError" in second["exception"]
+
+
+# committed rows, every poll closes connections left in a transaction
+@responses.activate
+@pytest.mark.django_db(transaction=True)
+def test_sync_daemon(monkeypatch, settings, tmp_path):
+    settings.STATS_METRICS_FILE = str(tmp_path / "metrics.prom")
+    responses.add(
+        responses.POST,
+        settings.DMPONLINE_AUTH_URL,
+        json={"access_token": "foo"},
+        status=200,
+    )
+    responses.add(
+        responses.GET, settings.AVG_REGISTRY_URL + "externals/", json=[], status=200
+    )
+    with open("test_files/out3.json") as f:
+        responses.add(
+            responses.GET,
+            settings.DMPONLINE_API_V0_URL + "statistics/plans",
+            json=json.load(f),
+            status=200,
+        )
+    with open("test_files/out4.json") as f:
+        responses.add(
+            responses.GET,
+            f"{settings.DMPONLINE_API_V0_URL}plans?page=1",
+            json=json.load(f),
+            status=200,
+        )
+    responses.add(
+        responses.GET, f"{settings.DMPONLINE_API_V0_URL}plans?page=2", json=[]
+    )
+    # 76258 is synced, 76277 was updated in DMPonline after its last sync
+    synced = datetime(2021, 4, 24, 13, 51, 22, tzinfo=timezone.utc)
+    DMP.objects.create(dmp_id=76258, type=1, last_updated=synced)
+    DMP.objects.create(dmp_id=76277, type=1, last_updated=synced - timedelta(days=1))
+
+    processed = []
+
+    def process_plan(run, item, avg_register):
+        run.counters["total_dmps"] += 1
+        processed.append(item["id"])
+        return True
+
+    monkeypatch.setattr(sync_daemon, "map_plans", lambda run, pool, page: page)
+    monkeypatch.setattr(sync_daemon, "process_plan", process_plan)
+    call_command("sync_daemon", "--once")
+
+    assert len(processed) == 9 and 76258 not in processed and 76277 in processed
+    run = SyncRun.objects.get()
+    assert run.status == SyncRun.FINISHED and run.end_page == 1
+    assert run.counters["unchanged_dmps"] == 1
+    # connectors are kept: one authentication for the sweep and both pages
+    assert len([c for c in responses.calls if c.request.method == "POST"]) == 1
+
+
+def test_mapping_pool():
+    with open("test_files/out.json") as f:
+        plan = json.load(f)
+    with open("test_files/out4.json") as f:
+        page = [plan] + json.load(f)[:2]
+
+    mapping = map_plan(plan)
+    assert mapping["id"] == 83643
+    assert mapping["avg"]["sourcekey"] == 83643
+    assert mapping["sharepoint"]["Title"].startswith("Develop")
+    assert mapping["stats"]["storage_amount"] == "< 250 GB"
+    assert mapping["stats"]["emails"] == [user["email"] for user in plan["users"]]
+    assert map_plan(page[1]) is None  # not a mappable template
+
+    with mapping_pool(2) as pool:
+        assert list(pool.map(map_plan, page)) == [mapping, None, None]
+
+
+@pytest.mark.django_db
+def test_shards(settings, tmp_path):
+    settings.STATS_METRICS_FILE = str(tmp_path / "metrics.prom")
+    assert parse_shard("2/4") == (2, 4)
+    for value in ("4", "0/4", "5/4", "a/b"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_shard(value)
+    shards = [shard_pages(10, 21, shard, 3) for shard in (1, 2, 3)]
+    assert sorted(sum(shards, [])) == list(range(10, 21))
+    assert shards[0] == [10, 13, 16, 19] and shards[2] == [12, 15, 18]
+    assert shard_pages(1, 4, 1, 3) == [1]
+
+    batch = get_batch_run("backfill", 10, 21, 2)
+    assert get_batch_run("backfill", 10, 21, 2) == batch
+    first, second = [
+        SyncRun.objects.create(
+            begin_page=10,
+            end_page=21,
+            counters=Counter(),
+            stage_seconds=Counter(),
+            parent=batch,
+            shard=shard,
+        )
+        for shard in (1, 2)
+    ]
+    assert lease_plan(first, 1) and lease_plan(first, 1)
+    assert not lease_plan(second, 1)
+    PlanLease.objects.filter(plan_id=1).update(expires=datetime.now(timezone.utc))
+    assert lease_plan(second, 1)
+
+    first.counters["total_dmps"] += 10
+    finish_run(first, SyncRun.FINISHED)
+    finish_batch(first)
+    batch.refresh_from_db()
+    assert batch.status == SyncRun.RUNNING
+
+    second.counters.update(total_dmps=5, leased_dmps=1)
+    finish_run(second, SyncRun.FINISHED)
+    finish_batch(second)
+    batch.refresh_from_db()
+    assert batch.status == SyncRun.FINISHED
+    assert batch.counters == {"total_dmps": 15, "leased_dmps": 1}
+    assert not PlanLease.objects.exists()
+    with pytest.raises(CommandError):
+        get_batch_run("backfill", 10, 21, 2)
+
+
+@pytest.mark.django_db
+def test_run_lease(monkeypatch):
+    first = Lease("fetch", seconds=60)
+    assert first.acquire()
+    second = Lease("fetch", seconds=60)
+    assert not second.acquire()
+    assert not second.acquire(steal=True)  # the first one is alive
+
+    # a fetch skips while the lease is held, before doing any request
+    call_command("fetch", "-b", "1", "-e", "2")
+    assert not SyncRun.objects.exists()
+
+    RunLease.objects.update(expires=datetime.now(timezone.utc) - timedelta(seconds=1))
+    assert second.acquire(steal=True)
+    assert not first.renew() and first.lost.is_set()
+    first.release()
+    assert RunLease.objects.get().holder == second.holder
+
+    # waiting until the holder releases the lease
+    third = Lease("fetch", seconds=60)
+    monkeypatch.setattr(leases.time, "sleep", lambda seconds: second.release())
+    assert third.acquire(wait=True)
+    assert RunLease.objects.get().holder == third.holder
+    third.release()
+    assert not RunLease.objects.exists()
+
+    # the shards of a batch share the lease, other fetches are kept out
+    shard = Lease("fetch", seconds=60, group="batch")
+    other_shard = Lease("fetch", seconds=60, group="batch")
+    assert shard.acquire() and other_shard.acquire()
+    assert not Lease("fetch", seconds=60, group="other batch").acquire()
+    assert not Lease("fetch", seconds=60).acquire()
+    call_command("fetch", "-b", "1", "-e", "2", "--shard", "1/2", "--batch", "other")
+    assert not SyncRun.objects.exists()
+    shard.release()
+    assert RunLease.objects.get().holders == 1
+    assert other_shard.renew()
+    other_shard.release()
+    assert not RunLease.objects.exists()
+
+    # the lease of a killed fetch is taken over once it expired
+    killed = Lease("fetch", seconds=60)
+    assert killed.acquire()
+    killed.stopped.set()
+    RunLease.objects.update(expires=datetime.now(timezone.utc) - timedelta(seconds=1))
+    shard = Lease("fetch", seconds=60, group="batch")
+    assert shard.acquire()
+    assert RunLease.objects.get().group == "batch"
+    shard.release()
+
+
+@responses.activate
+@pytest.mark.django_db
+def test_process_plan(mailoutbox):
+    responses.add(
+        responses.POST,
+        settings.SHAREPOINT_URL + "sites/dmponline2avg/avg/_api/contextinfo",
+        json={"d": {"GetContextWebInformation": {"FormDigestValue": "foo"}}},
+    )
+    responses.add(
+        responses.POST,
+        settings.SHAREPOINT_URL + "sites/dmponline2avg/avg/_api/"
+        "web/lists/GetByTitle(%27AVG%27)/items",
+        status=201,
+    )
+    responses.add(
+        responses.POST,
+        settings.AVG_REGISTRY_URL + "avgregisterline/external/",
+        status=201,
+    )
+    responses.add(
+        responses.PUT, settings.AVG_REGISTRY_URL + "avgregisterline/7/", status=200
+    )
+    responses.add(
+        responses.GET,
+        re.compile(re.escape(settings.ESB_URL + "faculty/get")),
+        json={"organisatieEenheid": {"afkortingNLVolledig": "TNW-BT-BTS"}},
+    )
+    with open("test_files/out.json") as f:
+        mapping = map_plan(json.load(f))
+    run = SyncRun.objects.create(
+        begin_page=1, end_page=2, counters=Counter(), stage_seconds=Counter()
+    )
+
+    # not in the AVG registry yet: inserted
+    assert process_plan(run, mapping, [])
+    assert run.counters["dj_avg_ins"] == 1 and run.counters["stats_ins"] == 1
+    dmp = DMP.objects.get(dmp_id=83643)
+    departments = dmp.researchers.values_list("faculty_department__name", flat=True)
+    assert list(departments) == ["TNW-BT", "TNW-BT"]
+
+    # in the AVG registry: updated, a DMP stored without a creation date gets one
+    DMP.objects.update(created=None)
+    assert DMP.objects.get().storage_locations.exists()
+    # the plan was updated: answers changed and storage locations removed
+    mapping["stats"] = {
+        **mapping["stats"],
+        "personal_data": False,
+        "storage_locations": [],
+        "share_types": ["Repository"],
+    }
+    avg_register = [{"sourcekey": "83643", "avgregisterline": {"id": 7}}]
+    assert process_plan(run, mapping, avg_register)
+    assert run.counters["dj_avg_upd"] == 1 and run.counters["stats_ins"] == 2
+    assert run.counters["dj_avg_fail"] == 0
+    assert DMP.objects.count() == 1
+    assert DMP.objects.get().created == datetime(
+        2021, 9, 2, 8, 31, 44, tzinfo=timezone.utc
+    )
+    dmp = DMP.objects.get()
+    assert dmp.personal_data is False and not dmp.storage_locations.exists()
+    assert list(dmp.share_types.values_list("name", flat=True)) == ["Repository"]
+    assert not mailoutbox
+
+    assert not process_plan(run, None, avg_register)
+    assert run.counters["total_dmps"] == 3 and run.counters["mappable_dmps"] == 2
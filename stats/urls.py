@@ -3,6 +3,22 @@ import stats.views as views
 
 urlpatterns = [
     path("raw", views.index, name="stats"),
+    path("facets", views.facets, name="facets"),
     path("", views.stats, name="index"),
     path("filter", views.stats_filter, name="filter"),
+    path("crosstab", views.crosstab, name="crosstab"),
+    path("timeseries", views.timeseries, name="timeseries"),
+    path("storage", views.storage, name="storage"),
+    path("capacity", views.capacity, name="capacity"),
+    path("researchers", views.researchers, name="researchers"),
+    path("metrics", views.metrics, name="metrics"),
+    path("runs", views.runs, name="runs"),
+    path("progress", views.progress, name="progress"),
+    path("export.csv", views.export, {"export_format": "csv"}, name="export_csv"),
+    path(
+        "export.ndjson",
+        views.export,
+        {"export_format": "ndjson"},
+        name="export_ndjson",
+    ),
 ]
@@ -1,35 +1,34 @@
 import json
-from django.db.models import Count, Q
-from django.http import JsonResponse, HttpResponse
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, JsonResponse, HttpResponse, StreamingHttpResponse
 from django.template.response import TemplateResponse
-from stats.models import DMP
-
-AGGREGATES = [
-    ("template_name", "Template kind"),
-    ("users__faculty_department__name", "Faculty-Department"),
-    ("human_participants", "Work with human participants"),
-    ("personal_data", "Work with personal data"),
-    ("confidential_data", "Work with confidential data"),
-    ("storage_locations__name", "Used storage location"),
-    ("data_amount", "Data amount"),
-    ("data_types_public__name", "What types of data will be shared"),
-    ("share_types__name", "How will research data be shared"),
-    ("data_amount_public", "How much data will be made public"),
-]
-
-
-def index(request):
+from stats.aggregates import (
+    AGGREGATES,
+    STORAGE_FIELDS,
+    compute_aggregates,
+    get_aggregates_async,
+    get_researcher_counts,
+    get_rollups,
+    get_storage_distribution,
+)
+from stats.cache import cache_stats, conditional_stats
+from stats.capacity import CAPACITY_GROUPS, get_capacity
+from stats.export import export_csv, export_ndjson, export_rows, filter_dmps, spool
+from stats.facets import get_facet_index, get_snapshot
+from stats.models import SyncRun
+from stats.routers import read_database
+from stats.snapshot import load_snapshot
+
+
+@read_database
+@conditional_stats
+@cache_stats
+async def index(request):
+    aggregates = await dashboard_aggregates()
     types = [
-        [
-            [question[1], "total"],
-            *list(
-                DMP.objects.filter(**{})
-                .values(question[0])
-                .annotate(total=Count("*"))  # Count("*") includes null values
-                .values_list(question[0], "total")
-            ),
-        ]
-        for question in AGGREGATES
+        [[question[1], "total"], *aggregates[question[0]]] for question in AGGREGATES
     ]
     # replace null (None) with "Unknown" (for Google Chart to understand it)
     types = replace_whr(types)
@@ -37,45 +36,40 @@ def index(request):
     return JsonResponse({"types": types}, safe=False)
 
 
-def stats(request):
+# the same as index, counted from the DMP table in one database round trip
+@read_database
+@conditional_stats
+@cache_stats
+def facets(request):
+    aggregates = compute_aggregates()
+    types = [
+        [[question[1], "total"], *aggregates[question[0]]] for question in AGGREGATES
+    ]
+    types = replace_whr(types)
+
+    return JsonResponse({"types": types}, safe=False)
+
+
+@read_database
+@conditional_stats
+@cache_stats
+async def stats(request):
+    aggregates = await dashboard_aggregates()
     questions = [
-        {
-            question: list(
-                DMP.objects.all()
-                .order_by(question[0])
-                .values_list(question[0], flat=True)
-                .distinct()
-            )
-        }
+        {question: [value for value, total in aggregates[question[0]]]}
         for question in AGGREGATES
     ]
     return TemplateResponse(request, "stats.html", {"questions": questions})
 
 
-def stats_filter(request):
-    qss = Q()
-    for item in request.GET:
-        qs = Q()
-        for search in request.GET.getlist(item):
-            if search != "None":
-                qs |= Q(**{item[:-2] + "__in": [search]})
-            else:
-                qs |= Q(**{item[:-2] + "__isnull": True})
-        qss &= qs
-
+@read_database
+@conditional_stats
+@cache_stats
+async def stats_filter(request):
+    index = await sync_to_async(get_facet_index)()
+    aggregates = index.counts(index.mask(get_filters(request)))
     types = [
-        [
-            [question[1], "total"],
-            *list(
-                DMP.objects.filter(qss)
-                .values(question[0])
-                .distinct()
-                .order_by(question[0])
-                .annotate(total=Count("*"))  # Count("*") includes null values
-                .values_list(question[0], "total")
-            ),
-        ]
-        for question in AGGREGATES
+        [[question[1], "total"], *aggregates[question[0]]] for question in AGGREGATES
     ]
 
     # replace null (None) with "Unknown" (for Google Chart to understand it)
@@ -86,15 +80,182 @@ def stats_filter(request):
     )
 
 
+@read_database
+@conditional_stats
+@cache_stats
+def crosstab(request):
+    questions = dict(AGGREGATES)
+    row, col = request.GET.get("row"), request.GET.get("col")
+    if row not in questions or col not in questions:
+        return JsonResponse(
+            {"error": "row and col must be one of: " + ", ".join(questions)},
+            status=400,
+        )
+
+    index = get_facet_index()
+    table = index.crosstab(row, col, index.mask(get_filters(request)))
+    header = [questions[row] + " / " + questions[col]]
+    if table:
+        header += [replace_value(value) for value, total in table[0][1]]
+    types = [
+        header,
+        *[
+            [replace_value(value), *[total for col_value, total in totals]]
+            for value, totals in table
+        ],
+    ]
+    return JsonResponse({"types": types}, safe=False)
+
+
+@read_database
+@conditional_stats
+@cache_stats
+def timeseries(request):
+    questions = dict(AGGREGATES)
+    question = request.GET.get("question")
+    if question not in questions:
+        return JsonResponse(
+            {"error": "question must be one of: " + ", ".join(questions)}, status=400
+        )
+
+    rollups = get_rollups(question)
+    values = []
+    for month, totals in rollups:
+        values += [value for value, total in totals if value not in values]
+    types = [
+        ["Month", *[replace_value(value) for value in values]],
+        *[
+            [month.strftime("%Y-%m"), *[dict(totals).get(value, 0) for value in values]]
+            for month, totals in rollups
+        ],
+    ]
+    return JsonResponse({"title": questions[question], "types": types}, safe=False)
+
+
+# histogram rows are [bucket lower bound in bytes, DMPs, total bytes, open-ended]
+@read_database
+@conditional_stats
+@cache_stats
+def storage(request):
+    return JsonResponse(
+        {field: get_storage_distribution(field) for field in STORAGE_FIELDS}
+    )
+
+
+# grouped rows are [group, total bytes, DMPs], honours the stats_filter parameters
+@read_database
+@conditional_stats
+@cache_stats
+def capacity(request):
+    snapshot = get_snapshot()
+    index = get_facet_index(snapshot)
+    rows = index.rows(index.mask(get_filters(request)))
+    result = {}
+    for field in STORAGE_FIELDS:
+        result[field] = get_capacity(snapshot, field, rows)
+        for question, name in CAPACITY_GROUPS:
+            result[field][name] = [
+                [replace_value(value), total, count]
+                for value, total, count in result[field][name]
+            ]
+    return JsonResponse(result)
+
+
+@read_database
+@conditional_stats
+@cache_stats
+def researchers(request):
+    types = replace_whr(
+        [[["Faculty-Department", "researchers"], *get_researcher_counts()]]
+    )
+    return JsonResponse({"types": types}, safe=False)
+
+
+# the rows are streamed after the view (and read_database) returned, so the
+# queryset names the read database itself
+# Django 3.2's ASGI handler iterates a streaming response on the event loop,
+# where the queries can't run (async iteration needs Django 4.2), so under ASGI
+# the view's thread writes the export to a temporary file it is served from
+@read_database
+@conditional_stats
+def export(request, export_format):
+    queryset = filter_dmps(get_filters(request)).using(settings.STATS_READ_DATABASE)
+    rows = export_rows(queryset)
+    if export_format == "csv":
+        lines, content_type = export_csv(rows), "text/csv"
+    else:
+        lines, content_type = export_ndjson(rows), "application/x-ndjson"
+    if isinstance(request, ASGIRequest):
+        response = FileResponse(spool(lines), content_type=content_type)
+    else:
+        response = StreamingHttpResponse(lines, content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="dmps.{export_format}"'
+    return response
+
+
+# the status file of the running (or last) fetch, see stats.progress
+def progress(request):
+    try:
+        with open(settings.STATS_PROGRESS_FILE) as progress_file:
+            return HttpResponse(progress_file.read(), content_type="application/json")
+    except FileNotFoundError:
+        return JsonResponse({"error": "no fetch has reported progress yet"}, status=404)
+
+
+# the latest fetch runs, newest first, ?limit=n (default 50)
+@read_database
+def runs(request):
+    try:
+        limit = int(request.GET.get("limit", 50))
+    except ValueError:
+        return JsonResponse({"error": "limit must be a number"}, status=400)
+    fields = [field.name for field in SyncRun._meta.fields]
+    return JsonResponse(
+        {"runs": list(SyncRun.objects.order_by("-started").values(*fields)[:limit])}
+    )
+
+
+# the Prometheus text file written by the last (or running) fetch
+def metrics(request):
+    try:
+        with open(settings.STATS_METRICS_FILE) as metrics_file:
+            content = metrics_file.read()
+    except FileNotFoundError:
+        content = ""
+    return HttpResponse(content, content_type="text/plain; version=0.0.4")
+
+
+# filters as sent by the filter form, the [] of the multiple select names stripped
+def get_filters(request):
+    return {
+        item[:-2]: request.GET.getlist(item)
+        for item in request.GET
+        if item.endswith("[]")
+    }
+
+
+# counts from the snapshot written by fetch, which needs no database access,
+# or from the aggregates table (or concurrent queries) before the first snapshot
+async def dashboard_aggregates():
+    if await sync_to_async(load_snapshot)():
+        return (await sync_to_async(get_facet_index)()).counts()
+    return await get_aggregates_async()
+
+
 def replace_whr(types):
     for i in range(len(types)):
         for j in range(1, len(types[i])):
-            if types[i][j][0] is None:
-                types[i][j] = "Unknown", types[i][j][1]
-            if types[i][j][0] is False:
-                types[i][j] = "No", types[i][j][1]
-            if types[i][j][0] is True:
-                types[i][j] = "Yes", types[i][j][1]
-            if type(types[i][j][0]) is int:
-                types[i][j] = str(types[i][j][0]), types[i][j][1]
+            types[i][j] = replace_value(types[i][j][0]), types[i][j][1]
     return types
+
+
+def replace_value(value):
+    if value is None:
+        return "Unknown"
+    if value is False:
+        return "No"
+    if value is True:
+        return "Yes"
+    if type(value) is int:
+        return str(value)
+    return value